@@ -1,11 +1,29 @@
+import traceback
 from functools import wraps
+from json import loads
+from os import getenv
 
 from selenium import webdriver
+from selenium.common.exceptions import ElementClickInterceptedException
+from selenium.common.exceptions import ElementNotInteractableException
+from selenium.common.exceptions import InvalidCookieDomainException
+from selenium.common.exceptions import InvalidSessionIdException
 from selenium.common.exceptions import NoSuchElementException
+from selenium.common.exceptions import StaleElementReferenceException
+from selenium.common.exceptions import TimeoutException
+from selenium.common.exceptions import WebDriverException
+from selenium.webdriver.chromium.remote_connection import ChromiumRemoteConnection
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
-from webdriver_manager.chrome import ChromeDriverManager
+from urllib3.exceptions import HTTPError
+
+from browser_profile import block_urls
+from browser_profile import BROWSER_PROFILE
+from browser_profile import BrowserUsage
+from browser_profile import chrome_options
+from chromedriver import chrome_driver
+from tracing import traced
 
 
 class AmazonBalanceReloaderException(Exception):
@@ -31,93 +49,269 @@ def throwable(message):
     return throwable
 
 
+# Overridable so that the reload flow can be benchmarked against a local stand-in, see benchmarks/fake_amazon.py.
+AMAZON_URL = getenv("AMAZON_URL", "https://www.amazon.com")
+# Seconds to wait for each step of the reload flow. Override individual steps with a JSON object in the
+# RELOADER_TIMEOUTS environment variable, e.g. {"checkout": 20}.
+DEFAULT_TIMEOUTS = {
+    "page_load": 30,
+    "sign_in": 10,
+    # Wait up to 10 minutes in case Amazon sends an SMS challenge that needs to be verified by the user.
+    "sms_challenge": 600,
+    "session_check": 10,
+    "reload_form": 10,
+    "checkout": 20,
+    "verify_card": 30,
+    "confirmation": 20,
+    "sign_out": 10,
+}
+STEP_TIMEOUTS = {**DEFAULT_TIMEOUTS, **loads(getenv("RELOADER_TIMEOUTS", "{}"))}
+
+
+# WebDriver errors that leave the browser session unusable.
+DRIVER_FAILURES = [
+    "chrome not reachable",
+    "disconnected",
+    "invalid session id",
+    "no such window",
+    "session deleted",
+    "target window already closed",
+]
+
+
+def error_class(exception):
+    # Classifies why a step failed: "driver" when the browser is gone, "timeout" and "element" for page trouble that
+    # may pass, and the exception type for anything else.
+    cause = (
+        exception.exception
+        if isinstance(exception, AmazonBalanceReloaderException)
+        else exception
+    )
+    if (
+        isinstance(cause, (InvalidSessionIdException, ConnectionError, HTTPError))
+        or isinstance(cause, WebDriverException)
+        and any(failure in str(cause.msg).lower() for failure in DRIVER_FAILURES)
+    ):
+        return "driver"
+    if isinstance(cause, TimeoutException):
+        return "timeout"
+    if isinstance(
+        cause,
+        (
+            ElementClickInterceptedException,
+            ElementNotInteractableException,
+            NoSuchElementException,
+            StaleElementReferenceException,
+        ),
+    ):
+        return "element"
+    return type(cause).__name__
+
+
+def first_of(**conditions):
+    # Races several expected conditions and evaluates to the name of the first one that holds.
+    def first_of(driver):
+        for (name, condition) in conditions.items():
+            try:
+                if condition(driver):
+                    return name
+            except (NoSuchElementException, StaleElementReferenceException):
+                pass
+        return False
+
+    return first_of
+
+
+def sampled(f):
+    # Samples the browser usage once the step is done, whether or not it succeeded.
+    @wraps(f)
+    def wrapper(self, *args, **kwds):
+        try:
+            return f(self, *args, **kwds)
+        finally:
+            self.sample_usage()
+
+    return wrapper
+
+
 class AmazonBalanceReloader:
     @throwable("Unable to connect to chromedriver!")
-    def __init__(self, driver):
+    def __init__(self, driver, timeouts=None):
         self.driver = driver
-        self.driver.implicitly_wait(5)
+        self.timeouts = {**STEP_TIMEOUTS, **(timeouts or {})}
+        # Every lookup goes through an explicit wait, so absent elements never stall on an implicit wait.
+        self.driver.implicitly_wait(0)
+        self.driver.set_page_load_timeout(self.timeouts["page_load"])
+        # Signing out invalidates the session cookies, so cached sessions are left signed in.
+        self.keep_session = False
+        self.submitted = False
+        self.usage = BrowserUsage()
+        try:
+            block_urls(self.driver)
+        except WebDriverException:
+            # Pages still load without the blocklist, just slower.
+            traceback.print_exc()
 
     def __enter__(self):
         return self
 
+    def sample_usage(self):
+        try:
+            self.usage.sample(self.driver)
+        except WebDriverException:
+            # Usage is only informational, so a browser that can't report it is not an error.
+            pass
+
+    def quit(self):
+        self.sample_usage()
+        self.driver.quit()
+
+    def wait(self, step, condition):
+        return WebDriverWait(self.driver, self.timeouts[step]).until(condition)
+
+    def wait_for_visible(self, step, xpath):
+        return self.wait(step, EC.visibility_of_element_located((By.XPATH, xpath)))
+
+    def wait_for_clickable(self, step, xpath):
+        return self.wait(step, EC.element_to_be_clickable((By.XPATH, xpath)))
+
     @throwable("Authentication failed!")
+    @traced("browser.authenticate")
+    @sampled
     def authenticate(self, username, password):
-        self.driver.get("https://www.amazon.com/asv/reload/order")
-        self.driver.find_element_by_xpath(
-            "//button[contains(text(), 'Sign In')]"
+        self.driver.get(f"{AMAZON_URL}/asv/reload/order")
+        self.wait_for_clickable(
+            "sign_in", "//button[contains(text(), 'Sign In')]"
         ).click()
-        self.driver.find_element_by_xpath("//input[@type='email']").send_keys(username)
-        self.driver.find_element_by_xpath("//*[@type='submit']").click()
-        self.driver.find_element_by_xpath("//input[@type='password']").send_keys(
+        self.wait_for_visible("sign_in", "//input[@type='email']").send_keys(username)
+        self.wait_for_clickable("sign_in", "//*[@type='submit']").click()
+        self.wait_for_visible("sign_in", "//input[@type='password']").send_keys(
             password
         )
-        self.driver.find_element_by_xpath("//*[@type='submit']").click()
+        self.wait_for_clickable("sign_in", "//*[@type='submit']").click()
         # Verify that authentication is successful and we are redirected back to the order page.
-        # Wait up to 10 minutes in case Amazon sends an SMS challenge that needs to be verified by the user.
-        WebDriverWait(self.driver, 600).until(
-            EC.visibility_of_element_located((By.ID, "asv-manual-reload-amount"))
+        self.wait(
+            "sms_challenge",
+            EC.visibility_of_element_located((By.ID, "asv-manual-reload-amount")),
         )
 
+    @throwable("Unable to restore session!")
+    @traced("browser.restore_session")
+    @sampled
+    def restore_session(self, cookies):
+        # Cookies can only be added for the domain that is currently loaded.
+        self.driver.get(f"{AMAZON_URL}/")
+        for cookie in cookies:
+            try:
+                self.driver.add_cookie(cookie)
+            except InvalidCookieDomainException:
+                pass
+        self.driver.get(f"{AMAZON_URL}/asv/reload/order")
+        try:
+            self.wait(
+                "session_check",
+                EC.visibility_of_element_located((By.ID, "asv-manual-reload-amount")),
+            )
+            return True
+        except TimeoutException:
+            # The cookies have expired, so start the full login from a clean slate.
+            self.driver.delete_all_cookies()
+            return False
+
+    def session_cookies(self):
+        return self.driver.get_cookies()
+
     @throwable("Unable to reload card!")
+    @sampled
     def reload(self, card_number, amount):
-        self.driver.get("https://www.amazon.com/asv/reload/order")
-        self.driver.find_element_by_id("asv-manual-reload-amount").send_keys(
-            str(amount)
+        verify_card_input = f"//*[contains(@class, 'pmts-selected')]//input[contains(@placeholder, '{card_number[-4:]}')]"
+        confirmation = "//*[contains(text(), 'your reload order is placed')]"
+        # Set while the order may have been placed without being confirmed, in which case retrying could charge twice.
+        self.submitted = False
+        self.driver.get(f"{AMAZON_URL}/asv/reload/order")
+        self.wait(
+            "reload_form",
+            EC.visibility_of_element_located((By.ID, "asv-manual-reload-amount")),
+        ).send_keys(str(amount))
+        self.wait_for_clickable(
+            "reload_form", f"//*[text()='ending in {card_number[-4:]}']"
+        ).click()
+        self.submitted = True
+        self.wait_for_clickable("reload_form", "//*[@id='form-submit-button']").click()
+        # Amazon either places the order right away or asks to verify the full card number first.
+        if (
+            self.wait(
+                "checkout",
+                first_of(
+                    verify_card=EC.visibility_of_element_located(
+                        (By.XPATH, verify_card_input)
+                    ),
+                    confirmation=EC.presence_of_element_located(
+                        (By.XPATH, confirmation)
+                    ),
+                ),
+            )
+            == "confirmation"
+        ):
+            return
+        # Amazon won't place the order until the card is verified.
+        self.submitted = False
+        self.wait_for_visible("verify_card", verify_card_input).send_keys(
+            str(card_number)
         )
-        self.driver.find_element_by_xpath(
-            f"//*[text()='ending in {card_number[-4:]}']"
+        self.wait_for_clickable(
+            "verify_card",
+            "//*[contains(@class, 'pmts-selected')]//*[text()='Verify card']",
         ).click()
-        self.driver.find_element_by_xpath(f"//*[@id='form-submit-button']").click()
-        try:
-            self.driver.find_element_by_xpath(
-                f"//*[contains(@class, 'pmts-selected')]//input[contains(@placeholder, '{card_number[-4:]}')]"
-            ).send_keys(str(card_number))
-            self.driver.find_element_by_xpath(
-                "//*[contains(@class, 'pmts-selected')]//*[text()='Verify card']"
-            ).click()
-            WebDriverWait(self.driver, 30).until(
-                EC.invisibility_of_element_located(
-                    (
-                        By.XPATH,
-                        "//*[contains(@class, 'pmts-loading-async-widget-spinner-overlay')]",
-                    )
+        self.wait(
+            "verify_card",
+            EC.invisibility_of_element_located(
+                (
+                    By.XPATH,
+                    "//*[contains(@class, 'pmts-loading-async-widget-spinner-overlay')]",
                 )
-            )
-            self.driver.find_element_by_xpath(f"//*[@id='form-submit-button']").click()
-        except NoSuchElementException:
-            pass
+            ),
+        )
+        self.submitted = True
+        self.wait_for_clickable("verify_card", "//*[@id='form-submit-button']").click()
         # Verify that the reload was successful.
-        self.driver.find_element_by_xpath(
-            "//*[contains(text(), 'your reload order is placed')]"
+        self.wait(
+            "confirmation", EC.presence_of_element_located((By.XPATH, confirmation))
         )
 
     @throwable("Unable to sign out!")
+    @traced("browser.sign_out")
     def __exit__(self, type, value, tb):
+        if self.keep_session:
+            self.quit()
+            return
         try:
             self.driver.get(
-                "https://www.amazon.com/gp/flex/sign-out.html?signIn=1&useRedirectOnSuccess=1&action=sign-out"
+                f"{AMAZON_URL}/gp/flex/sign-out.html?signIn=1&useRedirectOnSuccess=1&action=sign-out"
             )
-            self.driver.find_element_by_xpath("//input[@type='email']")
+            self.wait_for_visible("sign_out", "//input[@type='email']")
         except Exception as inst:
-            self.driver.quit()
+            self.quit()
             raise inst
-        self.driver.quit()
+        self.quit()
 
 
 class LocalAmazonBalanceReloader(AmazonBalanceReloader):
+    @throwable("Unable to start chromedriver!")
     def __init__(self):
-        super().__init__(webdriver.Chrome(ChromeDriverManager().install()))
+        super().__init__(chrome_driver(chrome_options(remote=False)))
 
 
 class RemoteAmazonBalanceReloader(AmazonBalanceReloader):
+    @throwable("Unable to connect to chromedriver!")
     def __init__(self, host):
-        chrome_options = webdriver.ChromeOptions()
-        # @TODO(darrennchan8): Make sure that Compute Engine maps /dev/shm in docker container.
-        #       Otherwise, we'll need to uncomment the following line.
-        # chrome_options.add_argument('--disable-dev-shm-usage')
-        chrome_options.add_argument("--headless")
+        # The Chromium connection also carries the CDP commands that the lean profile needs.
         driver = webdriver.Remote(
-            desired_capabilities=chrome_options.to_capabilities(),
-            command_executor=f"http://{host}/wd/hub",
+            command_executor=ChromiumRemoteConnection(
+                remote_server_addr=f"http://{host}/wd/hub",
+                vendor_prefix="goog",
+                browser_name="chrome",
+            ),
+            options=chrome_options(remote=True),
         )
         super().__init__(driver)
@@ -0,0 +1,224 @@
+from argparse import ArgumentParser
+from http.cookies import SimpleCookie
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from threading import Thread
+from time import sleep
+from urllib.parse import parse_qs
+from urllib.parse import urlparse
+from uuid import uuid4
+
+PAGE = """<!doctype html>
+<html>
+    <head><title>{title}</title></head>
+    <body>{body}</body>
+</html>"""
+
+SIGN_IN_PAGE = """
+<h1>Reload Your Balance</h1>
+<button onclick="location.href='/ap/signin'">Sign In</button>
+"""
+
+EMAIL_PAGE = """
+<form method="post" action="/ap/signin">
+    <input type="email" name="email"/>
+    <input type="submit" value="Continue"/>
+</form>
+"""
+
+PASSWORD_PAGE = """
+<form method="post" action="/ap/signin/password">
+    <input type="password" name="password"/>
+    <input type="submit" value="Sign-In"/>
+</form>
+"""
+
+ORDER_PAGE = """
+<form method="post" action="/asv/reload/order">
+    <input id="asv-manual-reload-amount" name="amount"/>
+    <input id="card" type="hidden" name="card"/>
+    {cards}
+    <button id="form-submit-button" type="submit">Reload $<span>0.00</span></button>
+</form>
+"""
+
+CARD_OPTION = """
+<div><span onclick="document.getElementById('card').value='{last4}'">ending in {last4}</span></div>
+"""
+
+# Amazon asks to re-enter the full card number, shows a spinner while verifying it and then needs another submit.
+VERIFY_CARD_PAGE = """
+<style>
+    .pmts-loading-async-widget-spinner-overlay {{
+        position: fixed; top: 0; left: 0; width: 100%; height: 100%; background: rgba(0, 0, 0, 0.2);
+    }}
+</style>
+<form method="post" action="/asv/reload/order">
+    <input type="hidden" name="amount" value="{amount}"/>
+    <input type="hidden" name="card" value="{last4}"/>
+    <input type="hidden" name="verified" value="1"/>
+    <div class="pmts-selected">
+        <input placeholder="ending in {last4}"/>
+        <span onclick="verify()">Verify card</span>
+    </div>
+    <button id="form-submit-button" type="submit">Reload</button>
+</form>
+<script>
+    function verify() {{
+        const overlay = document.createElement('div');
+        overlay.className = 'pmts-loading-async-widget-spinner-overlay';
+        document.body.appendChild(overlay);
+        setTimeout(() => overlay.remove(), {spinner_ms});
+    }}
+</script>
+"""
+
+CONFIRMATION_PAGE = """
+<h4>Thank you, your reload order is placed.</h4>
+<p>${amount} will be charged to the card ending in {last4}.</p>
+"""
+
+
+class FakeAmazon:
+    def __init__(self, cards, latency=0, verify_every=0, spinner_ms=500):
+        # Card numbers by last four digits. Every verify_every-th card asks for card verification.
+        self.cards = {card[-4:]: card for card in cards}
+        self.verify = {
+            card[-4:]
+            for (i, card) in enumerate(cards)
+            if verify_every and i % verify_every == verify_every - 1
+        }
+        self.latency = latency
+        self.spinner_ms = spinner_ms
+        self.sessions = set()
+        self.orders = []
+        self.requests = 0
+
+    def start(self, host="127.0.0.1", port=0):
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.thread = Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return f"http://{host}:{self.server.server_address[1]}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handler(self):
+        site = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def session(self):
+                cookie = SimpleCookie(self.headers.get("Cookie", ""))
+                return (
+                    "session-id" in cookie
+                    and cookie["session-id"].value in site.sessions
+                )
+
+            def form(self):
+                length = int(self.headers.get("Content-Length", 0))
+                return {
+                    k: v[0]
+                    for (k, v) in parse_qs(self.rfile.read(length).decode()).items()
+                }
+
+            def respond(self, body, title="Amazon", headers=None):
+                content = PAGE.format(title=title, body=body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/html; charset=utf-8")
+                self.send_header("Content-Length", str(len(content)))
+                for (name, value) in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(content)
+
+            def redirect(self, location, headers=None):
+                self.send_response(303)
+                self.send_header("Location", location)
+                self.send_header("Content-Length", "0")
+                for (name, value) in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+
+            def do_GET(self):
+                site.requests += 1
+                sleep(site.latency / 1000)
+                path = urlparse(self.path).path
+                if path == "/asv/reload/order":
+                    if not self.session():
+                        return self.respond(SIGN_IN_PAGE)
+                    return self.respond(
+                        ORDER_PAGE.format(
+                            cards="".join(
+                                CARD_OPTION.format(last4=last4) for last4 in site.cards
+                            )
+                        )
+                    )
+                if path == "/ap/signin":
+                    return self.respond(EMAIL_PAGE, "Amazon Sign-In")
+                if path == "/gp/flex/sign-out.html":
+                    return self.respond(
+                        EMAIL_PAGE,
+                        "Amazon Sign-In",
+                        {"Set-Cookie": "session-id=; Max-Age=0; Path=/"},
+                    )
+                return self.respond("<h1>Amazon</h1>")
+
+            def do_POST(self):
+                site.requests += 1
+                sleep(site.latency / 1000)
+                path = urlparse(self.path).path
+                form = self.form()
+                if path == "/ap/signin":
+                    return self.respond(PASSWORD_PAGE, "Amazon Sign-In")
+                if path == "/ap/signin/password":
+                    session_id = uuid4().hex
+                    site.sessions.add(session_id)
+                    return self.redirect(
+                        "/asv/reload/order",
+                        {"Set-Cookie": f"session-id={session_id}; Path=/"},
+                    )
+                if path == "/asv/reload/order" and self.session():
+                    if form.get("card") in site.verify and not form.get("verified"):
+                        return self.respond(
+                            VERIFY_CARD_PAGE.format(
+                                amount=form.get("amount", ""),
+                                last4=form["card"],
+                                spinner_ms=site.spinner_ms,
+                            )
+                        )
+                    if form.get("card") in site.cards:
+                        site.orders.append((form["card"], form.get("amount")))
+                        return self.respond(
+                            CONFIRMATION_PAGE.format(
+                                amount=form.get("amount", ""), last4=form["card"]
+                            )
+                        )
+                self.send_error(400)
+
+        return Handler
+
+
+if __name__ == "__main__":
+    argparser = ArgumentParser(
+        description="Serve a local stand-in for the Amazon balance reload pages.",
+        allow_abbrev=False,
+    )
+    argparser.add_argument("--port", type=int, default=8081)
+    argparser.add_argument("--cards", nargs="+", default=["4111111111111111"])
+    argparser.add_argument(
+        "--latency", type=int, default=0, help="milliseconds added to every request"
+    )
+    argparser.add_argument(
+        "--verify-every",
+        type=int,
+        default=0,
+        help="ask to verify every nth card, 0 to never ask",
+    )
+    args = argparser.parse_args()
+    site = FakeAmazon(args.cards, args.latency, args.verify_every)
+    print(f"Serving the fake reload site on {site.start(port=args.port)}.")
+    site.thread.join()
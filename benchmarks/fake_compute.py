@@ -0,0 +1,159 @@
+from copy import deepcopy
+from re import findall
+from threading import Lock
+from time import monotonic
+from time import sleep
+
+
+def fake_instance(name, ip, network_tag="standalone-chrome", status="RUNNING"):
+    return {
+        "name": name,
+        "status": status,
+        "tags": {"items": [network_tag]},
+        "networkInterfaces": [
+            {"accessConfigs": [{"name": "External NAT", "natIP": ip}]}
+        ],
+    }
+
+
+def matches_filter(instance, filter):
+    # Understands the (field = "value") AND (...) expressions that ComputeSession sends.
+    for (field, value) in findall(r'([\w.]+)\s*=\s*"([^"]*)"', filter or ""):
+        if field == "tags.items":
+            if value not in instance.get("tags", {}).get("items", []):
+                return False
+        elif instance.get(field) != value:
+            return False
+    return True
+
+
+class FakeRequest:
+    def __init__(self, api, method, f):
+        self.api = api
+        self.method = method
+        self.f = f
+
+    def execute(self):
+        with self.api.lock:
+            self.api.calls[self.method] = self.api.calls.get(self.method, 0) + 1
+        sleep(self.api.latency / 1000)
+        with self.api.lock:
+            self.api.refresh()
+            return self.f()
+
+
+class FakeInstances:
+    def __init__(self, api):
+        self.api = api
+
+    def aggregatedList(self, project, filter=None, fields=None):
+        return FakeRequest(
+            self.api,
+            "instances.aggregatedList",
+            lambda: {
+                "items": {
+                    f"zones/{zone}": {
+                        "instances": [
+                            deepcopy(instance)
+                            for instance in instances
+                            if matches_filter(instance, filter)
+                        ]
+                    }
+                    for (zone, instances) in self.api.zones.items()
+                }
+            },
+        )
+
+    def aggregatedList_next(self, previous_request, previous_response):
+        return None
+
+    def get(self, project, zone, instance, fields=None):
+        return FakeRequest(
+            self.api,
+            "instances.get",
+            lambda: deepcopy(self.api.instance(zone, instance)),
+        )
+
+    def start(self, project, zone, instance):
+        def start():
+            # Instances stay STAGING for boot_seconds, see FakeComputeApi.refresh.
+            self.api.instance(zone, instance)["status"] = "STAGING"
+            self.api.booting[instance] = monotonic() + self.api.boot_seconds
+            return {"status": "RUNNING"}
+
+        return FakeRequest(self.api, "instances.start", start)
+
+    def stop(self, project, zone, instance):
+        def stop():
+            self.api.instance(zone, instance)["status"] = "TERMINATED"
+            self.api.booting.pop(instance, None)
+            return {"status": "RUNNING"}
+
+        return FakeRequest(self.api, "instances.stop", stop)
+
+
+class FakeFirewalls:
+    def __init__(self, api):
+        self.api = api
+
+    def list(self, project, filter=None):
+        return FakeRequest(
+            self.api,
+            "firewalls.list",
+            lambda: {
+                "items": [
+                    deepcopy(rule)
+                    for rule in self.api.firewall_rules.values()
+                    if matches_filter(rule, filter)
+                ]
+            },
+        )
+
+    def insert(self, project, body):
+        def insert():
+            # The API returns the network as a full URL.
+            self.api.firewall_rules[body["name"]] = {
+                **deepcopy(body),
+                "network": f"https://www.googleapis.com/compute/v1/projects/{project}/{body['network']}",
+            }
+            return {"status": "DONE"}
+
+        return FakeRequest(self.api, "firewalls.insert", insert)
+
+    def patch(self, project, firewall, body):
+        def patch():
+            self.api.firewall_rules[firewall].update(deepcopy(body))
+            return {"status": "DONE"}
+
+        return FakeRequest(self.api, "firewalls.patch", patch)
+
+
+# A stand-in for the discovery-built Compute API resource that ComputeSession uses.
+class FakeComputeApi:
+    def __init__(self, zones=None, latency=0, boot_seconds=0):
+        # Instances by zone, see fake_instance.
+        self.zones = zones or {}
+        self.latency = latency
+        self.boot_seconds = boot_seconds
+        self.booting = {}
+        self.firewall_rules = {}
+        self.calls = {}
+        self.lock = Lock()
+
+    def instance(self, zone, name):
+        return next(
+            instance for instance in self.zones[zone] if instance["name"] == name
+        )
+
+    def refresh(self):
+        for (zone, instances) in self.zones.items():
+            for instance in instances:
+                if self.booting.get(instance["name"], float("inf")) <= monotonic():
+                    instance["status"] = "RUNNING"
+                    del self.booting[instance["name"]]
+
+    def instances(self):
+        return FakeInstances(self)
+
+    def firewalls(self):
+        return FakeFirewalls(self)
@@ -0,0 +1,268 @@
+from copy import deepcopy
+from datetime import datetime
+from datetime import timezone
+from threading import RLock
+from time import sleep
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+from uuid import uuid4
+
+from google.api_core.exceptions import Conflict
+from google.api_core.exceptions import FailedPrecondition
+from google.cloud.firestore import Increment
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self.update_time = update_time
+        self._data = data
+
+    def to_dict(self):
+        return deepcopy(self._data)
+
+    def get(self, field):
+        return self._data[field]
+
+
+class FakeDocumentReference:
+    def __init__(self, client, collection, id):
+        self._client = client
+        self._collection = collection
+        self.id = id
+
+    @property
+    def path(self):
+        return f"{self._collection}/{self.id}"
+
+    def get(self):
+        with self._client.round_trip("read"):
+            data, update_time = self._client.store.get(self.path, (None, None))
+            return FakeSnapshot(self, deepcopy(data), update_time)
+
+    def set(self, data, merge=False):
+        with self._client.round_trip("write"):
+            existing = self._client.store.get(self.path, (None, None))[0]
+            self._client.store[self.path] = (
+                merge_fields(existing or {}, data) if merge else deepcopy(data),
+                datetime.now(timezone.utc),
+            )
+
+    def create(self, data):
+        with self._client.round_trip("write"):
+            if self._client.store.get(self.path, (None, None))[0] is not None:
+                raise Conflict(f"Document already exists: {self.path}")
+            self._client.store[self.path] = (
+                deepcopy(data),
+                datetime.now(timezone.utc),
+            )
+
+    def update(self, data, option=None):
+        with self._client.round_trip("write"):
+            existing, update_time = self._client.store.get(self.path, (None, None))
+            if existing is None:
+                raise KeyError(f"No document to update: {self.path}")
+            if option is not None and option.last_update_time != update_time:
+                raise FailedPrecondition(f"Document was updated since: {self.path}")
+            for (field_path, value) in data.items():
+                *parents, field = field_path.split(".")
+                target = existing
+                for parent in parents:
+                    target = target.setdefault(parent, {})
+                target[field] = deepcopy(value)
+            self._client.store[self.path] = (existing, datetime.now(timezone.utc))
+
+    def delete(self):
+        with self._client.round_trip("write"):
+            self._client.store.pop(self.path, None)
+
+
+def merge_fields(existing, data):
+    merged = deepcopy(existing)
+    for (k, v) in data.items():
+        if isinstance(v, dict):
+            merged[k] = merge_fields(
+                merged[k] if isinstance(merged.get(k), dict) else {}, v
+            )
+        elif isinstance(v, Increment):
+            merged[k] = merged.get(k, 0) + v.value
+        else:
+            merged[k] = deepcopy(v)
+    return merged
+
+
+class FakeWriteOption:
+    def __init__(self, last_update_time):
+        self.last_update_time = last_update_time
+
+
+class FakeWriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append((reference, data, merge))
+
+    def commit(self):
+        # Applied in one round trip, like a real batch.
+        with self._client.round_trip("write"):
+            for (reference, data, merge) in self._writes:
+                existing = self._client.store.get(reference.path, (None, None))[0]
+                self._client.store[reference.path] = (
+                    merge_fields(existing or {}, data)
+                    if merge
+                    else merge_fields({}, data),
+                    datetime.now(timezone.utc),
+                )
+        self._writes = []
+
+
+class FakeQuery:
+    ASCENDING = "ASCENDING"
+    DESCENDING = "DESCENDING"
+
+    def __init__(
+        self, client, collection, orders=(), filters=(), cursor=None, count=None
+    ):
+        self._client = client
+        self._collection = collection
+        self._orders = orders
+        self._filters = filters
+        self._cursor = cursor
+        self._count = count
+
+    def _copy(self, **kwds):
+        return FakeQuery(
+            self._client,
+            self._collection,
+            **{
+                "orders": self._orders,
+                "filters": self._filters,
+                "cursor": self._cursor,
+                "count": self._count,
+                **kwds,
+            },
+        )
+
+    def order_by(self, field, direction=ASCENDING):
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, op, value),))
+
+    def limit(self, count):
+        return self._copy(count=count)
+
+    def start_after(self, snapshot):
+        return self._copy(cursor=snapshot)
+
+    def stream(self):
+        with self._client.round_trip("read"):
+            prefix = f"{self._collection}/"
+            snapshots = [
+                FakeSnapshot(
+                    FakeDocumentReference(
+                        self._client, self._collection, path[len(prefix) :]
+                    ),
+                    deepcopy(data),
+                    update_time,
+                )
+                for (path, (data, update_time)) in list(self._client.store.items())
+                if path.startswith(prefix) and "/" not in path[len(prefix) :]
+            ]
+        # Like Firestore, ordering by a field excludes documents that do not have it.
+        snapshots = [
+            snapshot
+            for snapshot in snapshots
+            if all(field in snapshot._data for (field, _) in self._orders)
+            and all(
+                matches(snapshot._data.get(field), op, value)
+                for (field, op, value) in self._filters
+            )
+        ]
+        for (field, direction) in reversed(
+            self._orders or (("__name__", "ASCENDING"),)
+        ):
+            snapshots.sort(
+                key=lambda snapshot: snapshot.id
+                if field == "__name__"
+                else snapshot.get(field),
+                reverse=direction == self.DESCENDING,
+            )
+        if self._cursor is not None:
+            ids = [snapshot.id for snapshot in snapshots]
+            snapshots = snapshots[ids.index(self._cursor.id) + 1 :]
+        return iter(snapshots[: self._count] if self._count is not None else snapshots)
+
+
+def matches(actual, op, value):
+    return {
+        "==": lambda: actual == value,
+        "!=": lambda: actual != value,
+        "<": lambda: actual is not None and actual < value,
+        "<=": lambda: actual is not None and actual <= value,
+        ">": lambda: actual is not None and actual > value,
+        ">=": lambda: actual is not None and actual >= value,
+        "in": lambda: actual in value,
+        "array_contains": lambda: value in (actual or []),
+    }[op]()
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client, collection):
+        super().__init__(client, collection)
+        self.id = collection
+
+    def document(self, id=None):
+        return FakeDocumentReference(self._client, self._collection, id or uuid4().hex)
+
+    def add(self, data):
+        reference = self.document()
+        reference.set(data)
+        return (datetime.now(timezone.utc), reference)
+
+
+# An in-memory stand-in for firestore.Client that covers the calls made by this project. Every instance shares the
+# same store so that separately created clients see the same database, and every call sleeps for the configured
+# latency to stand in for a network round trip.
+class FakeFirestoreClient:
+    # Document paths to (data, update time).
+    store: Dict[str, Tuple[Optional[dict], Optional[datetime]]] = {}
+    latency = 0
+    calls = {"read": 0, "write": 0}
+    lock = RLock()
+
+    def __init__(self, *args, **kwds):
+        pass
+
+    def round_trip(self, kind):
+        FakeFirestoreClient.calls[kind] += 1
+        sleep(FakeFirestoreClient.latency / 1000)
+        return FakeFirestoreClient.lock
+
+    def collection(self, name):
+        return FakeCollectionReference(self, name)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def write_option(self, last_update_time):
+        return FakeWriteOption(last_update_time)
+
+    def get_all(self, references):
+        with self.round_trip("read"):
+            snapshots = []
+            for reference in references:
+                data, update_time = self.store.get(reference.path, (None, None))
+                snapshots.append(FakeSnapshot(reference, deepcopy(data), update_time))
+            return snapshots
+
+    @classmethod
+    def reset(cls, latency=0):
+        cls.store.clear()
+        cls.latency = latency
+        cls.calls = {"read": 0, "write": 0}
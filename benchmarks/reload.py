@@ -0,0 +1,187 @@
+from argparse import ArgumentParser
+from os import environ
+from sys import argv
+from types import SimpleNamespace
+
+from google.cloud import firestore
+from requests import get
+
+from benchmarks.fake_amazon import FakeAmazon
+from benchmarks.fake_compute import fake_instance
+from benchmarks.fake_compute import FakeComputeApi
+from benchmarks.fake_firestore import FakeFirestoreClient
+
+
+def install_fakes(compute_api, amazon_url):
+    # Clients are created on first use and AMAZON_URL is read once the reloader is first used, so these only
+    # have to be in place before the first batch runs.
+    environ["AMAZON_URL"] = amazon_url
+    firestore.Client = FakeFirestoreClient
+    import compute_session
+
+    compute_session.compute_credentials = lambda: (None, "benchmark")
+    compute_session.compute_api = lambda: compute_api
+    # Only the egress IP lookup is faked, the remote path health-checks a real selenium hub.
+    compute_session.get = (
+        lambda url, **kwds: SimpleNamespace(text="127.0.0.1\n")
+        if url.startswith("https://checkip.amazonaws.com")
+        else get(url, **kwds)
+    )
+
+
+def use_profile(profile):
+    import amazon_balance_reloader
+    import browser_profile
+
+    browser_profile.BROWSER_PROFILE = profile
+    amazon_balance_reloader.BROWSER_PROFILE = profile
+
+
+def step_totals(spans):
+    # Per-card spans are named "browser.reload <card>", so group them by their first word.
+    totals = {}
+    for span in spans:
+        step = span["name"].split(" ")[0]
+        totals[step] = totals.get(step, 0) + span["duration"]
+    return totals
+
+
+def run(args):
+    card_numbers = [f"4111{i:012d}" for i in range(max(args.cards))]
+    site = FakeAmazon(card_numbers, args.latency, args.verify_every)
+    amazon_url = site.start(args.site_host)
+    FakeFirestoreClient.reset(args.firestore_latency)
+    compute_api = FakeComputeApi(
+        {
+            "us-central1-a": [
+                fake_instance(
+                    "selenium",
+                    args.remote_host,
+                    status="TERMINATED" if args.stopped else "RUNNING",
+                )
+            ]
+        },
+        args.compute_latency,
+        args.boot_seconds,
+    )
+    install_fakes(compute_api, amazon_url)
+    import main
+    from secrets import add_card
+    from secrets import get_cards
+    from secrets import get_credentials
+    from secrets import reset_secrets
+
+    key = reset_secrets("benchmark@example.com", "benchmark")
+    for (i, number) in enumerate(card_numbers):
+        add_card(key, f"card {i:03d}", number)
+    cards = sorted(get_cards(key).items())
+    print(f"Fake reload site on {amazon_url}")
+    for driver in args.drivers:
+        # main.py decides between the local and the remote webdriver by this command line flag.
+        if "--compute-instance-webdriver" in argv:
+            argv.remove("--compute-instance-webdriver")
+        if driver == "remote":
+            argv.append("--compute-instance-webdriver")
+        for profile in args.profiles:
+            use_profile(profile)
+            for count in args.cards:
+                for repetition in range(args.repetitions):
+                    orders = len(site.orders)
+                    result = main.reload_batch(
+                        get_credentials(key),
+                        dict(cards[:count]),
+                        1.0,
+                        sessions=args.sessions,
+                    )
+                    elapsed = (
+                        result["timestamp_end"] - result["timestamp_start"]
+                    ).total_seconds()
+                    usage = result["browser_usage"]
+                    print(
+                        f"{driver:>6} {profile:>4} {count:>4} cards #{repetition + 1}  "
+                        f"{elapsed:>8.2f} s end-to-end  "
+                        f"{result['success'].count(True)}/{count} reloaded  "
+                        f"{len(site.orders) - orders} orders placed  "
+                        f"{usage['bytes_transferred'] / 1024:>8.0f} KiB  "
+                        f"{usage['peak_js_heap_bytes'] / 1024 / 1024:>6.1f} MiB peak heap"
+                    )
+                    for (step, total) in sorted(step_totals(result["spans"]).items()):
+                        print(f"{'':>25}{step:<28}{total / 1000:>8.2f} s")
+                    if result["backend_boot_seconds"] is not None:
+                        print(
+                            f"{'':>25}{'boot to ready':<28}{result['backend_boot_seconds']:>8.2f} s"
+                        )
+    print(
+        f"Firestore: {FakeFirestoreClient.calls['read']} reads, {FakeFirestoreClient.calls['write']} writes"
+    )
+    print(
+        "Compute API: "
+        + ", ".join(
+            f"{count} {method}" for (method, count) in compute_api.calls.items()
+        )
+    )
+    site.stop()
+
+
+if __name__ == "__main__":
+    argparser = ArgumentParser(
+        description="Benchmark reload batches offline against local stand-ins for Amazon, Firestore and the Compute API.",
+        allow_abbrev=False,
+    )
+    argparser.add_argument(
+        "--cards", type=int, nargs="+", default=[1, 2, 4], help="batch sizes to run"
+    )
+    argparser.add_argument(
+        "--drivers",
+        nargs="+",
+        choices=["local", "remote"],
+        default=["local"],
+        help="remote needs a selenium hub on REMOTE_HOST:4444 that can reach the fake site",
+    )
+    argparser.add_argument(
+        "--profiles",
+        nargs="+",
+        choices=["lean", "full"],
+        default=["lean"],
+        help="browser profiles to compare, see browser_profile.py",
+    )
+    argparser.add_argument("--sessions", type=int, default=1)
+    argparser.add_argument("--repetitions", type=int, default=1)
+    argparser.add_argument(
+        "--latency",
+        type=int,
+        default=0,
+        help="milliseconds added to every fake Amazon request",
+    )
+    argparser.add_argument(
+        "--firestore-latency",
+        type=int,
+        default=0,
+        help="milliseconds added to every fake Firestore call",
+    )
+    argparser.add_argument(
+        "--compute-latency",
+        type=int,
+        default=0,
+        help="milliseconds added to every fake Compute API call",
+    )
+    argparser.add_argument(
+        "--verify-every",
+        type=int,
+        default=2,
+        help="ask to verify every nth card, 0 to never ask",
+    )
+    argparser.add_argument(
+        "--stopped",
+        action="store_true",
+        help="start with the fake selenium instance stopped, so the remote path boots it first",
+    )
+    argparser.add_argument(
+        "--boot-seconds",
+        type=float,
+        default=0,
+        help="seconds the fake instance takes to boot",
+    )
+    argparser.add_argument("--site-host", default="127.0.0.1")
+    argparser.add_argument("--remote-host", default="127.0.0.1")
+    run(argparser.parse_args())
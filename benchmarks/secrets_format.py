@@ -0,0 +1,63 @@
+from argparse import ArgumentParser
+from secrets import decrypt_document
+from secrets import encrypt_document
+from secrets import gen_new_key
+from timeit import repeat
+
+
+def firestore_size(value):
+    # https://cloud.google.com/firestore/docs/storage-size
+    if isinstance(value, dict):
+        return sum(
+            len(k.encode("utf8")) + 1 + firestore_size(v) for (k, v) in value.items()
+        )
+    if isinstance(value, list):
+        return sum(firestore_size(v) for v in value)
+    if isinstance(value, str):
+        return len(value.encode("utf8")) + 1
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, (int, float)):
+        return 8
+    return 1
+
+
+def document_size(document_name, document):
+    # Each segment of the document name counts with one extra byte, plus 16 bytes for the name and 32 per document.
+    name_size = (
+        sum(len(segment.encode("utf8")) + 1 for segment in ("secrets", document_name))
+        + 16
+    )
+    return name_size + firestore_size(document) + 32
+
+
+def benchmark(card_counts, repetitions):
+    key = gen_new_key()
+    for count in card_counts:
+        cards = {f"card {i}": f"{i:016d}" for i in range(count)}
+        for version in (1, 2):
+            document = encrypt_document(key, cards, version)
+            assert decrypt_document(key, document) == cards
+            best = min(
+                repeat(
+                    lambda: decrypt_document(key, document),
+                    number=repetitions,
+                    repeat=5,
+                )
+            )
+            print(
+                f"{count:>5} cards  v{version}  "
+                f"decrypt {best / repetitions * 1e6:>10.1f} us  "
+                f"size {document_size('cards', document):>8} bytes"
+            )
+
+
+if __name__ == "__main__":
+    argparser = ArgumentParser(
+        description="Compare decrypt time and document size of the secrets storage formats.",
+        allow_abbrev=False,
+    )
+    argparser.add_argument("--cards", type=int, nargs="+", default=[1, 10, 100])
+    argparser.add_argument("--repetitions", type=int, default=100)
+    args = argparser.parse_args()
+    benchmark(args.cards, args.repetitions)
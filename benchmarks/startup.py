@@ -0,0 +1,78 @@
+from argparse import ArgumentParser
+from os import environ
+from statistics import median
+from subprocess import run
+from sys import executable
+
+MEASURE_IMPORT = """
+from time import perf_counter
+start = perf_counter()
+import main
+print(perf_counter() - start)
+"""
+
+
+def measure(repository, runs):
+    # Older revisions create their Firestore clients on import, which needs credentials unless an emulator is set.
+    env = {
+        "FIRESTORE_EMULATOR_HOST": "localhost:8080",
+        "GOOGLE_CLOUD_PROJECT": "benchmark",
+        **environ,
+    }
+    return [
+        float(
+            run(
+                [executable, "-c", MEASURE_IMPORT],
+                cwd=repository,
+                env=env,
+                capture_output=True,
+                check=True,
+                text=True,
+            ).stdout
+        )
+        for _ in range(runs)
+    ]
+
+
+def slowest_imports(repository, count):
+    stderr = run(
+        [executable, "-X", "importtime", "-c", "import main"],
+        cwd=repository,
+        env={"FIRESTORE_EMULATOR_HOST": "localhost:8080", **environ},
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stderr
+    imports = [
+        (int(line.split("|")[1]), line.split("|")[2].rstrip())
+        for line in stderr.splitlines()
+        if line.startswith("import time:") and line.split("|")[1].strip().isdigit()
+    ]
+    return sorted(imports, reverse=True)[:count]
+
+
+if __name__ == "__main__":
+    argparser = ArgumentParser(
+        description="Measure how long a fresh process takes to import main.py, e.g. on an App Engine cold start.",
+        allow_abbrev=False,
+    )
+    argparser.add_argument(
+        "--repository",
+        default=".",
+        help="checkout to measure, e.g. a git worktree of an older revision",
+    )
+    argparser.add_argument("--runs", type=int, default=10)
+    argparser.add_argument(
+        "--imports",
+        type=int,
+        default=10,
+        help="number of slowest cumulative imports to list",
+    )
+    args = argparser.parse_args()
+    timings = measure(args.repository, args.runs)
+    print(
+        f"import main: median {median(timings) * 1000:.0f} ms, "
+        f"min {min(timings) * 1000:.0f} ms over {args.runs} runs"
+    )
+    for (microseconds, module) in slowest_imports(args.repository, args.imports):
+        print(f"{microseconds / 1000:>10.1f} ms {module}")
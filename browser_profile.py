@@ -0,0 +1,121 @@
+from json import loads
+from os import getenv
+from shutil import disk_usage
+
+from selenium import webdriver
+
+# "lean" blocks everything the reload flow never looks at, "full" loads pages as a regular browser would.
+BROWSER_PROFILE = getenv("BROWSER_PROFILE", "lean").lower()
+# URL patterns that the lean profile never requests. Override with a JSON list in BROWSER_BLOCKED_URLS.
+DEFAULT_BLOCKED_URLS = [
+    # Images, fonts and media.
+    "*.png*",
+    "*.jpg*",
+    "*.jpeg*",
+    "*.gif*",
+    "*.webp*",
+    "*.ico*",
+    "*.woff*",
+    "*.ttf*",
+    "*.otf*",
+    "*.mp4*",
+    "*.webm*",
+    # Ads, tracking and metrics.
+    "*amazon-adsystem.com*",
+    "*fls-na.amazon.com*",
+    "*unagi.amazon.com*",
+    "*doubleclick.net*",
+    "*google-analytics.com*",
+    "*googletagmanager.com*",
+    "*facebook.net*",
+]
+BLOCKED_URLS = loads(getenv("BROWSER_BLOCKED_URLS", "null"))
+BLOCKED_URLS = DEFAULT_BLOCKED_URLS if BLOCKED_URLS is None else BLOCKED_URLS
+BROWSER_DISK_CACHE_MB = int(getenv("BROWSER_DISK_CACHE_MB", "16"))
+BROWSER_RENDERER_PROCESSES = int(getenv("BROWSER_RENDERER_PROCESSES", "2"))
+# Either true, false or auto.
+DISABLE_DEV_SHM_USAGE = getenv("DISABLE_DEV_SHM_USAGE", "auto").lower()
+# Docker only gives containers 64MB of /dev/shm by default, which is not enough for Chrome.
+MIN_DEV_SHM_BYTES = 512 * 1024 * 1024
+LEAN_ARGUMENTS = [
+    "--blink-settings=imagesEnabled=false",
+    "--disable-background-networking",
+    "--disable-component-update",
+    "--disable-default-apps",
+    "--disable-extensions",
+    "--disable-features=MediaRouter,OptimizationHints,Translate",
+    "--disable-sync",
+    "--mute-audio",
+    "--no-first-run",
+]
+
+
+def disable_dev_shm_usage(remote):
+    if DISABLE_DEV_SHM_USAGE != "auto":
+        return DISABLE_DEV_SHM_USAGE in ("1", "true", "yes")
+    if remote:
+        # The remote /dev/shm can't be inspected from here, and the selenium container may run with docker's default.
+        return True
+    try:
+        return disk_usage("/dev/shm").total < MIN_DEV_SHM_BYTES
+    except OSError:
+        return False
+
+
+def chrome_options(remote):
+    options = webdriver.ChromeOptions()
+    if remote:
+        options.add_argument("--headless")
+    if disable_dev_shm_usage(remote):
+        # Chrome writes its shared memory files to /tmp instead.
+        options.add_argument("--disable-dev-shm-usage")
+    # Both profiles are measured so that they can be compared, see BrowserUsage.
+    options.add_argument("--enable-precise-memory-info")
+    options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+    options.add_experimental_option(
+        "perfLoggingPrefs", {"enableNetwork": True, "enablePage": False}
+    )
+    if BROWSER_PROFILE != "lean":
+        return options
+    for argument in LEAN_ARGUMENTS:
+        options.add_argument(argument)
+    options.add_argument(f"--disk-cache-size={BROWSER_DISK_CACHE_MB * 1024 * 1024}")
+    options.add_argument(f"--renderer-process-limit={BROWSER_RENDERER_PROCESSES}")
+    options.add_experimental_option(
+        "prefs", {"profile.managed_default_content_settings.images": 2}
+    )
+    return options
+
+
+def block_urls(driver):
+    if BROWSER_PROFILE != "lean" or not BLOCKED_URLS:
+        return
+    driver.execute("executeCdpCommand", {"cmd": "Network.enable", "params": {}})
+    driver.execute(
+        "executeCdpCommand",
+        {"cmd": "Network.setBlockedURLs", "params": {"urls": BLOCKED_URLS}},
+    )
+
+
+class BrowserUsage:
+    def __init__(self):
+        self.bytes_transferred = 0
+        # Sampled after every step, so short spikes in between may be missed.
+        self.peak_js_heap_bytes = 0
+
+    def sample(self, driver):
+        # Reading the performance log drains it, so every response is only counted once.
+        for entry in driver.get_log("performance"):
+            message = loads(entry["message"])["message"]
+            if message["method"] == "Network.loadingFinished":
+                self.bytes_transferred += message["params"]["encodedDataLength"]
+        heap = driver.execute_script(
+            "return performance.memory && performance.memory.totalJSHeapSize;"
+        )
+        self.peak_js_heap_bytes = max(self.peak_js_heap_bytes, heap or 0)
+
+    def to_dict(self):
+        return {
+            "bytes_transferred": self.bytes_transferred,
+            "peak_js_heap_bytes": self.peak_js_heap_bytes,
+        }
@@ -0,0 +1,118 @@
+import atexit
+from json import dump
+from json import load
+from os import getenv
+from os import makedirs
+from os import replace
+from os.path import dirname
+from os.path import expanduser
+from os.path import isfile
+from os.path import join
+from threading import Lock
+from time import time
+
+from selenium import webdriver
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.chromium.remote_connection import ChromiumRemoteConnection
+from webdriver_manager.chrome import ChromeDriverManager
+from webdriver_manager.utils import ChromeType
+from webdriver_manager.utils import get_browser_version_from_os
+
+from tracing import span
+
+# Skips every lookup and uses this chromedriver binary as is.
+CHROMEDRIVER_PATH = getenv("CHROMEDRIVER_PATH")
+# The chromedriver binary that last worked with each installed Chrome version.
+CHROMEDRIVER_PINS = getenv(
+    "CHROMEDRIVER_PINS", join(expanduser("~"), ".wdm", "pinned_chromedriver.json")
+)
+# Within this many hours of the last check, the pinned binary is used without asking the network for a newer one.
+CHROMEDRIVER_CHECK_HOURS = float(getenv("CHROMEDRIVER_CHECK_HOURS", "24"))
+# Keep one chromedriver process running across batches instead of starting a new one for every browser.
+REUSE_CHROMEDRIVER_SERVICE = getenv("REUSE_CHROMEDRIVER_SERVICE", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+
+pins_lock = Lock()
+service_lock = Lock()
+shared_service = None
+
+
+def read_pins():
+    if not isfile(CHROMEDRIVER_PINS):
+        return {}
+    with open(CHROMEDRIVER_PINS) as f:
+        return load(f)
+
+
+def write_pins(pins):
+    makedirs(dirname(CHROMEDRIVER_PINS), exist_ok=True)
+    with open(f"{CHROMEDRIVER_PINS}.tmp", "w") as f:
+        dump(pins, f, indent=2)
+    replace(f"{CHROMEDRIVER_PINS}.tmp", CHROMEDRIVER_PINS)
+
+
+def chromedriver_path():
+    if CHROMEDRIVER_PATH:
+        return CHROMEDRIVER_PATH
+    with pins_lock, span("chromedriver.resolve"):
+        chrome_version = get_browser_version_from_os(ChromeType.GOOGLE)
+        pins = read_pins()
+        pin = pins.get(chrome_version)
+        pinned = pin is not None and isfile(pin["path"])
+        if pinned and time() - pin["checked"] < CHROMEDRIVER_CHECK_HOURS * 3600:
+            return pin["path"]
+        try:
+            path = ChromeDriverManager().install()
+        except Exception:
+            # Most likely offline, so keep using the binary that last worked with this Chrome version.
+            if pinned:
+                return pin["path"]
+            raise
+        pins[chrome_version] = {"path": path, "checked": time()}
+        write_pins(pins)
+        return path
+
+
+def chromedriver_service():
+    global shared_service
+    with service_lock:
+        if shared_service is None or not shared_service.is_connectable():
+            if shared_service is not None:
+                shared_service.stop()
+            service = Service(chromedriver_path())
+            with span("chromedriver.start"):
+                service.start()
+            shared_service = service
+        return shared_service
+
+
+@atexit.register
+def stop_chromedriver_service():
+    with service_lock:
+        if shared_service is not None:
+            shared_service.stop()
+
+
+def chrome_driver(options=None):
+    options = options or webdriver.ChromeOptions()
+    service = (
+        chromedriver_service()
+        if REUSE_CHROMEDRIVER_SERVICE
+        else Service(chromedriver_path())
+    )
+    with span("chromedriver.session"):
+        if not REUSE_CHROMEDRIVER_SERVICE:
+            # Quitting this driver also stops its chromedriver process.
+            return webdriver.Chrome(service=service, options=options)
+        # Attach to the running chromedriver, so quitting only ends this browser session.
+        return webdriver.Remote(
+            command_executor=ChromiumRemoteConnection(
+                remote_server_addr=service.service_url,
+                vendor_prefix="goog",
+                browser_name="chrome",
+            ),
+            options=options,
+        )
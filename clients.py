@@ -0,0 +1,70 @@
+from functools import lru_cache
+from importlib import import_module
+from os import getenv
+from threading import local
+
+COMPUTE_AUTH_SCOPES = [
+    "https://www.googleapis.com/auth/cloud-platform",
+    "https://www.googleapis.com/auth/compute",
+    "https://www.googleapis.com/auth/compute.readonly",
+]
+
+compute_apis = local()
+
+
+class LazyModule:
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        # import_module holds a lock per module, so concurrent first uses wait for one complete execution of it.
+        # importlib.util.LazyLoader makes no such guarantee before Python 3.12.
+        return getattr(import_module(self.name), attribute)
+
+
+def lazy_import(name):
+    # Defers executing a module until one of its attributes is first used, so that heavy dependencies like
+    # selenium and googleapiclient stay off the cold start path of requests that never touch them.
+    return LazyModule(name)
+
+
+def is_app_engine_environment():
+    return getenv("GAE_INSTANCE") is not None
+
+
+@lru_cache(maxsize=None)
+def firestore_client():
+    from google.cloud import firestore
+
+    return firestore.Client()
+
+
+def collection(name):
+    return firestore_client().collection(name)
+
+
+def project_id():
+    return firestore_client().project
+
+
+@lru_cache(maxsize=None)
+def compute_credentials():
+    import google.auth
+
+    return google.auth.default(scopes=COMPUTE_AUTH_SCOPES)
+
+
+def compute_api():
+    # API resources are not thread-safe, so every thread builds its own once. The discovery document comes from the
+    # static copy bundled with googleapiclient rather than from the network.
+    if getattr(compute_apis, "resource", None) is None:
+        from googleapiclient import discovery
+
+        compute_apis.resource = discovery.build(
+            "compute",
+            "v1",
+            credentials=compute_credentials()[0],
+            static_discovery=True,
+            cache_discovery=False,
+        )
+    return compute_apis.resource
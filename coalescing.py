@@ -0,0 +1,63 @@
+from os import getenv
+from threading import Event
+from threading import Lock
+from time import sleep
+
+# Batches for the same account and amount that arrive within this many seconds of each other share one run.
+COALESCE_WINDOW_SECONDS = float(getenv("COALESCE_WINDOW_SECONDS", "2"))
+
+
+class CoalescedBatch:
+    def __init__(self):
+        self.cards = {}
+        self.sessions = 1
+        self.requests = 0
+        self.done = Event()
+        self.result = None
+        self.exception = None
+
+
+class BatchCoalescer:
+    def __init__(self, window):
+        self.window = window
+        self.batches = {}
+        self.lock = Lock()
+
+    def run(self, group, cards, sessions, f):
+        # The first request of a group waits out the window and then calls f once with the union of every request's
+        # cards. Each request gets the result back with only the cards it asked for.
+        if self.window <= 0:
+            return {**f(cards, sessions), "coalesced_requests": 1}
+        with self.lock:
+            batch = self.batches.get(group)
+            leader = batch is None
+            if leader:
+                batch = self.batches[group] = CoalescedBatch()
+            batch.cards.update(cards)
+            batch.sessions = max(batch.sessions, sessions)
+            batch.requests += 1
+        if leader:
+            sleep(self.window)
+            with self.lock:
+                del self.batches[group]
+            try:
+                batch.result = f(batch.cards, batch.sessions)
+            except Exception as inst:
+                batch.exception = inst
+            finally:
+                batch.done.set()
+        else:
+            batch.done.wait()
+        if batch.exception is not None:
+            raise batch.exception
+        indices = [batch.result["cards"].index(name) for name in cards]
+        return {
+            **batch.result,
+            "cards": list(cards.keys()),
+            "success": [batch.result["success"][index] for index in indices],
+            "checkpoints": [batch.result["checkpoints"][index] for index in indices],
+            "coalesced_requests": batch.requests,
+        }
+
+
+batch_coalescer = BatchCoalescer(COALESCE_WINDOW_SECONDS)
@@ -1,25 +1,190 @@
-from functools import lru_cache
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
 from functools import wraps
 from os import getenv
+from threading import Lock
+from threading import Timer
+from time import monotonic
+from time import sleep
+from typing import Dict
+from typing import List
+from typing import Tuple
 
-import google
-from googleapiclient import discovery
 from requests import get
 
+from clients import collection
+from clients import compute_api
+from clients import compute_credentials
+from clients import is_app_engine_environment
+from tracing import span
+from tracing import traced
+
 FIREWALL_RULE_NAME = "temporary-compute-session-handle"
+COMPUTE_DISCOVERY_TTL = int(getenv("COMPUTE_DISCOVERY_TTL", "300"))
 
+SELF_IP_TTL = int(getenv("SELF_IP_TTL", "300"))
+# Keep the firewall rule open for this many seconds after the last session exits so back-to-back batches can reuse it.
+FIREWALL_LINGER_SECONDS = int(getenv("FIREWALL_LINGER_SECONDS", "0"))
+SELENIUM_PORT = 4444
+BACKEND_STATUS_TIMEOUT = float(getenv("BACKEND_STATUS_TIMEOUT", "3"))
+# A backend that fails is skipped for this many seconds, doubling with every consecutive failure up to the maximum.
+BACKEND_BACKOFF_SECONDS = float(getenv("BACKEND_BACKOFF_SECONDS", "30"))
+BACKEND_MAX_BACKOFF_SECONDS = float(getenv("BACKEND_MAX_BACKOFF_SECONDS", "600"))
+# Start a stopped instance when no tagged instance is running, and wait this long for its hub to become ready.
+INSTANCE_START_ON_DEMAND = getenv("INSTANCE_START_ON_DEMAND", "true").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+INSTANCE_BOOT_TIMEOUT = float(getenv("INSTANCE_BOOT_TIMEOUT", "300"))
+INSTANCE_POLL_SECONDS = float(getenv("INSTANCE_POLL_SECONDS", "5"))
+# Stop tagged instances whose hubs have had no sessions for this many seconds after the last batch. 0 never stops them.
+INSTANCE_IDLE_STOP_SECONDS = float(getenv("INSTANCE_IDLE_STOP_SECONDS", "0"))
+# When each network tag was last used and how long it is kept warm, shared by every App Engine instance.
+INSTANCE_USAGE_COLLECTION = "compute_instances"
+NEVER = datetime.min.replace(tzinfo=timezone.utc)
 
-def is_app_engine_environment():
-    return getenv("GAE_INSTANCE") is not None
+# Remote IPs by (project, network tag), shared by all sessions in this process.
+discovery_cache: Dict[Tuple[str, str], Tuple[float, List[str]]] = {}
+discovery_cache_lock = Lock()
+cached_self_ip = None
+self_ip_lock = Lock()
+# The firewall rule is shared by every session in this process, so it is only disabled once the last one exits.
+firewall_lock = Lock()
+active_sessions = 0
+applied_rule = None
+pending_close = None
+# Browser sessions this process runs on each backend, and (consecutive failures, skip until) of failing backends.
+backend_lock = Lock()
+backend_leases: Dict[str, int] = {}
+backend_failures: Dict[str, Tuple[int, float]] = {}
+# Only one session boots an instance at a time, the others wait for it and reuse the instance.
+boot_lock = Lock()
+# The idle check this process runs after its last batch, see schedule_idle_stop.
+idle_lock = Lock()
+pending_stop = None
 
 
-@lru_cache
-def project_id():
-    return google.auth.default()[1]
+def self_ip():
+    global cached_self_ip
+    with self_ip_lock:
+        if cached_self_ip and cached_self_ip[0] > monotonic():
+            return cached_self_ip[1]
+    with span("compute.self_ip"):
+        ip = get("https://checkip.amazonaws.com/").text.strip()
+    with self_ip_lock:
+        cached_self_ip = (monotonic() + SELF_IP_TTL, ip)
+    return ip
 
 
-def self_ip():
-    return get("https://checkip.amazonaws.com/").text.strip()
+def firewall_rule_differs(existing_rule, config):
+    # The API omits empty lists and expands the network into a full URL, so only compare what we set.
+    return (
+        any(
+            existing_rule.get(field) != config[field]
+            for field in (
+                "priority",
+                "direction",
+                "sourceRanges",
+                "description",
+                "allowed",
+                "targetTags",
+            )
+        )
+        or existing_rule.get("disabled", False) != config["disabled"]
+        or existing_rule.get("logConfig", {}).get("enable", False)
+        != config["logConfig"]["enable"]
+        or not existing_rule.get("network", "").endswith(config["network"])
+    )
+
+
+def backend_load(ip):
+    # Evaluates to (busy slots, total slots) of a healthy selenium hub. Grid hubs report every slot of every node,
+    # a standalone server only reports whether it is ready, so it counts as a single slot.
+    with span(f"selenium.status {ip}", "selenium.status"):
+        response = get(
+            f"http://{ip}:{SELENIUM_PORT}/wd/hub/status",
+            timeout=BACKEND_STATUS_TIMEOUT,
+        )
+    response.raise_for_status()
+    status = response.json()["value"]
+    if not status.get("ready", False):
+        raise Exception(f"Selenium backend {ip} is not ready: {status.get('message')}")
+    slots = [slot for node in status.get("nodes", []) for slot in node["slots"]]
+    return (len([slot for slot in slots if slot.get("session")]), len(slots) or 1)
+
+
+def mark_backend_unhealthy(ip):
+    with backend_lock:
+        failures = backend_failures.get(ip, (0, 0))[0] + 1
+        backoff = min(
+            BACKEND_BACKOFF_SECONDS * 2 ** (failures - 1), BACKEND_MAX_BACKOFF_SECONDS
+        )
+        backend_failures[ip] = (failures, monotonic() + backoff)
+
+
+def healthy_backend_loads(ips):
+    with backend_lock:
+        candidates = [
+            ip for ip in ips if backend_failures.get(ip, (0, 0))[1] <= monotonic()
+        ]
+    loads = {}
+    if not candidates:
+        return loads
+    with ThreadPoolExecutor(
+        max_workers=len(candidates), thread_name_prefix="backend-status"
+    ) as executor:
+        for (ip, future) in [
+            (ip, executor.submit(backend_load, ip)) for ip in candidates
+        ]:
+            try:
+                loads[ip] = future.result()
+            except Exception:
+                traceback.print_exc()
+                mark_backend_unhealthy(ip)
+    with backend_lock:
+        for ip in loads:
+            backend_failures.pop(ip, None)
+    return loads
+
+
+def external_ips(instances):
+    return [
+        access_config["natIP"]
+        for instance in instances
+        for network_interface in instance.get("networkInterfaces", [])
+        for access_config in network_interface.get("accessConfigs", [])
+        if access_config["name"] == "External NAT" and "natIP" in access_config
+    ]
+
+
+def schedule_idle_stop(remote_network_tag):
+    # Only a shortcut while this process lives, App Engine takes the timer along when it shuts an instance down. See
+    # /stopIdle for the check that a cron job runs.
+    global pending_stop
+    if INSTANCE_IDLE_STOP_SECONDS <= 0:
+        return
+    with idle_lock:
+        if pending_stop:
+            pending_stop.cancel()
+        pending_stop = Timer(
+            INSTANCE_IDLE_STOP_SECONDS,
+            scheduled_idle_check,
+            [remote_network_tag],
+        )
+        pending_stop.daemon = True
+        pending_stop.start()
+
+
+def cancel_idle_stop():
+    global pending_stop
+    with idle_lock:
+        if pending_stop:
+            pending_stop.cancel()
+            pending_stop = None
 
 
 class ComputeSessionException(Exception):
@@ -45,12 +210,68 @@ def throwable(message):
     return throwable
 
 
+def usage_reference(remote_network_tag):
+    return collection(INSTANCE_USAGE_COLLECTION).document(remote_network_tag)
+
+
+@throwable("Failed to read the usage of compute instances!")
+def read_usage(remote_network_tag):
+    with span("firestore.read instance usage"):
+        snapshot = usage_reference(remote_network_tag).get()
+    return snapshot.to_dict() if snapshot.exists else {}
+
+
+@throwable("Failed to record the usage of compute instances!")
+def write_usage(remote_network_tag, usage):
+    with span("firestore.write instance usage"):
+        usage_reference(remote_network_tag).set(usage, merge=True)
+
+
+def mark_used(remote_network_tag):
+    # A batch must not fail because its usage could not be recorded, the hubs' own session counts still protect it.
+    try:
+        write_usage(remote_network_tag, {"last_used": datetime.now(timezone.utc)})
+    except ComputeSessionException:
+        traceback.print_exc()
+
+
+def keep_warm(remote_network_tag, seconds):
+    # Keeps instances from being stopped for idleness for a while, e.g. ahead of a scheduled batch.
+    warm_until = datetime.now(timezone.utc) + timedelta(seconds=seconds)
+    if warm_until > read_usage(remote_network_tag).get("warm_until", NEVER):
+        write_usage(remote_network_tag, {"warm_until": warm_until})
+
+
+def idle_deadline(remote_network_tag):
+    usage = read_usage(remote_network_tag)
+    return max(
+        usage.get("last_used", NEVER) + timedelta(seconds=INSTANCE_IDLE_STOP_SECONDS),
+        usage.get("warm_until", NEVER),
+    )
+
+
 class MockComputeSession:
     def remote_ip(self):
         return self.mock_remote_ip
 
+    def remote_ips(self):
+        return [self.mock_remote_ip]
+
+    def select_backends(self, count):
+        return [self.mock_remote_ip] * count
+
+    def invalidate_remote_ips(self):
+        pass
+
+    def invalidate_firewall_rule(self):
+        pass
+
+    def mark_unhealthy(self, ip):
+        pass
+
     def __init__(self, mock_remote_ip):
         self.mock_remote_ip = mock_remote_ip
+        self.boot_seconds = None
 
     def __enter__(self):
         return self
@@ -61,64 +282,202 @@ class MockComputeSession:
 
 class ComputeSession:
     @throwable(
-        "Failed to determine the remote IP address associated with the given network tag!"
+        "Failed to determine the remote IP addresses associated with the given network tag!"
     )
-    @lru_cache
-    def remote_ip(self):
-        aggregated_instance_response = (
-            self.compute_api.instances()
-            .aggregatedList(project=self.project_id)
-            .execute()
+    @traced("compute.discover")
+    def remote_ips(self):
+        cache_key = (self.project_id, self.remote_network_tag)
+        with discovery_cache_lock:
+            cached = discovery_cache.get(cache_key)
+        if cached and cached[0] > monotonic():
+            return cached[1]
+        eligible_ips = self.discover_remote_ips()
+        if not eligible_ips:
+            if not INSTANCE_START_ON_DEMAND:
+                raise Exception(
+                    f"No running compute instances with the network tag {self.remote_network_tag} were found!"
+                )
+            with boot_lock:
+                # Another session may have booted an instance while this one was waiting.
+                eligible_ips = self.discover_remote_ips() or self.boot_instance()
+        with discovery_cache_lock:
+            discovery_cache[cache_key] = (
+                monotonic() + COMPUTE_DISCOVERY_TTL,
+                eligible_ips,
+            )
+        return eligible_ips
+
+    def tagged_instances(self, status, fields):
+        # Evaluates to (zone, instance) pairs. The API does the filtering and trims the response down to the fields
+        # that are used.
+        instances_api = self.compute_api.instances()
+        request = instances_api.aggregatedList(
+            project=self.project_id,
+            filter=f'(status = "{status}") AND (tags.items = "{self.remote_network_tag}")',
+            fields=f"nextPageToken,items/*/instances({fields})",
         )
-        all_instances = [
-            instance
-            for regions in aggregated_instance_response["items"].values()
-            for instance in regions.get("instances", [])
+        all_instances = []
+        while request is not None:
+            aggregated_instance_response = request.execute()
+            all_instances += [
+                (zone[len("zones/") :], instance)
+                for (zone, regions) in aggregated_instance_response.get(
+                    "items", {}
+                ).items()
+                for instance in regions.get("instances", [])
+            ]
+            request = instances_api.aggregatedList_next(
+                request, aggregated_instance_response
+            )
+        # The API filter already selects these instances, this merely guards against a partial match.
+        return [
+            (zone, instance)
+            for (zone, instance) in all_instances
+            if instance["status"] == status
+            and self.remote_network_tag in instance.get("tags", {}).get("items", [])
         ]
+
+    def discover_remote_ips(self):
         eligible_instances = [
             instance
-            for instance in all_instances
-            if instance["status"] == "RUNNING"
-            and self.remote_network_tag in instance["tags"]["items"]
-        ]
-        if not eligible_instances:
-            raise Exception(
-                f"No running compute instances with the network tag {self.remote_network_tag} were found!"
+            for (_, instance) in self.tagged_instances(
+                "RUNNING",
+                "name,status,tags/items,networkInterfaces/accessConfigs(name,natIP)",
             )
-        eligible_ips = [
-            access_config["natIP"]
-            for instance in eligible_instances
-            for network_interface in instance["networkInterfaces"]
-            for access_config in network_interface["accessConfigs"]
-            if access_config["name"] == "External NAT"
         ]
-        if not eligible_ips:
+        eligible_ips = external_ips(eligible_instances)
+        if eligible_instances and not eligible_ips:
             raise Exception(f"No external IP addresses were found!")
-        return eligible_ips[0]
+        return eligible_ips
+
+    @traced("compute.boot")
+    def boot_instance(self):
+        # Stopped instances report TERMINATED.
+        started = monotonic()
+        stopped_instances = self.tagged_instances(
+            "TERMINATED", "name,status,tags/items"
+        )
+        if not stopped_instances:
+            raise Exception(
+                f"No running or stopped compute instances with the network tag {self.remote_network_tag} were found!"
+            )
+        (zone, instance) = stopped_instances[0]
+        self.compute_api.instances().start(
+            project=self.project_id, zone=zone, instance=instance["name"]
+        ).execute()
+        # The instance gets its external IP once it is running, and the hub takes a while longer to start.
+        ips = []
+        while True:
+            if not ips:
+                booting_instance = (
+                    self.compute_api.instances()
+                    .get(
+                        project=self.project_id,
+                        zone=zone,
+                        instance=instance["name"],
+                        fields="status,networkInterfaces/accessConfigs(name,natIP)",
+                    )
+                    .execute()
+                )
+                if booting_instance["status"] == "RUNNING":
+                    ips = external_ips([booting_instance])
+            if ips:
+                try:
+                    backend_load(ips[0])
+                    break
+                except Exception:
+                    pass
+            if monotonic() - started > INSTANCE_BOOT_TIMEOUT:
+                raise Exception(
+                    f"Compute instance {instance['name']} was not ready within {INSTANCE_BOOT_TIMEOUT} seconds!"
+                )
+            sleep(INSTANCE_POLL_SECONDS)
+        self.boot_seconds = monotonic() - started
+        return ips
+
+    @throwable("Failed to stop idle compute instances!")
+    @traced("compute.stop_idle")
+    def stop_idle_instances(self):
+        with firewall_lock:
+            # This session is the one doing the check.
+            if active_sessions > 1:
+                return
+        for (zone, instance) in self.tagged_instances(
+            "RUNNING",
+            "name,status,tags/items,networkInterfaces/accessConfigs(name,natIP)",
+        ):
+            try:
+                # Batches of other processes may still be running on the instance.
+                if any(backend_load(ip)[0] for ip in external_ips([instance])):
+                    continue
+            except Exception:
+                # A hub that doesn't answer in time may well be busy, so only instances that report no sessions stop.
+                traceback.print_exc()
+                continue
+            self.compute_api.instances().stop(
+                project=self.project_id, zone=zone, instance=instance["name"]
+            ).execute()
+        self.invalidate_remote_ips()
+
+    def invalidate_remote_ips(self):
+        with discovery_cache_lock:
+            discovery_cache.pop((self.project_id, self.remote_network_tag), None)
+
+    def remote_ip(self):
+        return self.select_backends(1)[0]
+
+    @throwable("No healthy selenium backend is available!")
+    @traced("compute.select_backends")
+    def select_backends(self, count):
+        # Picks a backend for each of count browser sessions, least loaded first. Hub slots already in use by other
+        # processes and sessions of this process that have not shown up on the hub yet both count as load.
+        loads = healthy_backend_loads(self.remote_ips())
+        if not loads:
+            raise Exception("Every selenium backend failed its health check!")
+        selected = []
+        with backend_lock:
+            load = {
+                ip: busy + backend_leases.get(ip, 0)
+                for (ip, (busy, _)) in loads.items()
+            }
+            for _ in range(count):
+                ip = min(loads, key=lambda ip: load[ip] / loads[ip][1])
+                load[ip] += 1
+                backend_leases[ip] = backend_leases.get(ip, 0) + 1
+                selected.append(ip)
+        self.leases += selected
+        return selected
+
+    def release_backends(self):
+        with backend_lock:
+            for ip in self.leases:
+                backend_leases[ip] -= 1
+                if not backend_leases[ip]:
+                    del backend_leases[ip]
+        self.leases = []
+
+    def mark_unhealthy(self, ip):
+        mark_backend_unhealthy(ip)
+
+    def invalidate_firewall_rule(self):
+        global applied_rule
+        # The rule is shared by every App Engine instance, so another one may have pointed it at its own IP or disabled
+        # it since this process applied it. The next session checks it against the API again.
+        with firewall_lock:
+            applied_rule = None
 
     @throwable("Failed to use credentials for the Compute API!")
-    def __init__(self, remote_network_tag):
-        auth_scopes = [
-            "https://www.googleapis.com/auth/cloud-platform",
-            "https://www.googleapis.com/auth/compute",
-            "https://www.googleapis.com/auth/compute.readonly",
-        ]
-        credentials, self.project_id = google.auth.default(scopes=auth_scopes)
-        self.compute_api = discovery.build("compute", "v1", credentials=credentials)
+    @traced("compute.client")
+    def __init__(self, remote_network_tag, idle_check=False):
+        self.project_id = compute_credentials()[1]
+        self.compute_api = compute_api()
         self.remote_network_tag = remote_network_tag
+        self.leases = []
+        self.boot_seconds = None
+        self.idle_check = idle_check
 
-    @throwable("Failed to add/update session firewall rule to allow this connection!")
-    def __enter__(self):
-        existing_rule = next(
-            iter(
-                self.compute_api.firewalls()
-                .list(project=self.project_id, filter=f'name = "{FIREWALL_RULE_NAME}"')
-                .execute()
-                .get("items", [])
-            ),
-            None,
-        )
-        config = {
+    def firewall_rule(self):
+        return {
             "priority": 1000,
             "direction": "INGRESS",
             "sourceRanges": [f"{self_ip()}/32"],
@@ -135,20 +494,110 @@ class ComputeSession:
             "denied": [],
             "name": FIREWALL_RULE_NAME,
         }
-        if existing_rule:
+
+    @throwable("Failed to add/update session firewall rule to allow this connection!")
+    @traced("compute.firewall_open")
+    def __enter__(self):
+        global active_sessions, applied_rule, pending_close
+        config = self.firewall_rule()
+        if not self.idle_check:
+            cancel_idle_stop()
+            mark_used(self.remote_network_tag)
+        with firewall_lock:
+            active_sessions += 1
+            if pending_close:
+                pending_close.cancel()
+                pending_close = None
+            # A rule that this process opened and has not closed since needs no round trips at all.
+            if applied_rule == config:
+                return self
+            try:
+                existing_rule = next(
+                    iter(
+                        self.compute_api.firewalls()
+                        .list(
+                            project=self.project_id,
+                            filter=f'name = "{FIREWALL_RULE_NAME}"',
+                        )
+                        .execute()
+                        .get("items", [])
+                    ),
+                    None,
+                )
+                if not existing_rule:
+                    self.compute_api.firewalls().insert(
+                        project=self.project_id, body=config
+                    ).execute()
+                elif firewall_rule_differs(existing_rule, config):
+                    self.compute_api.firewalls().patch(
+                        project=self.project_id,
+                        firewall=FIREWALL_RULE_NAME,
+                        body=config,
+                    ).execute()
+            except Exception:
+                active_sessions -= 1
+                raise
+            applied_rule = config
+        return self
+
+    def close_firewall(self):
+        global applied_rule
+        with firewall_lock:
+            # Another session may have started while the rule was lingering.
+            if active_sessions:
+                return
             self.compute_api.firewalls().patch(
-                project=self.project_id, firewall=FIREWALL_RULE_NAME, body=config
-            ).execute()
-        else:
-            self.compute_api.firewalls().insert(
-                project=self.project_id, body=config
+                project=self.project_id,
+                firewall=FIREWALL_RULE_NAME,
+                body={"disabled": True},
             ).execute()
-        return self
+            applied_rule = None
 
     @throwable("Failed to disable session firewall rule!")
+    @traced("compute.firewall_close")
     def __exit__(self, type, value, tb):
-        self.compute_api.firewalls().patch(
-            project=self.project_id,
-            firewall=FIREWALL_RULE_NAME,
-            body={"disabled": True},
-        ).execute()
+        global active_sessions, pending_close
+        self.release_backends()
+        with firewall_lock:
+            active_sessions -= 1
+            if active_sessions or FIREWALL_LINGER_SECONDS <= 0:
+                linger = False
+            else:
+                linger = True
+                pending_close = Timer(
+                    FIREWALL_LINGER_SECONDS, close_lingering_firewall, [self]
+                )
+                pending_close.daemon = True
+                pending_close.start()
+        if not linger:
+            self.close_firewall()
+        if not active_sessions and not self.idle_check:
+            mark_used(self.remote_network_tag)
+            schedule_idle_stop(self.remote_network_tag)
+
+
+def close_lingering_firewall(session):
+    try:
+        session.close_firewall()
+    except Exception:
+        traceback.print_exc()
+
+
+def check_idle_instances(remote_network_tag):
+    # Evaluates to whether the instances have been idle for long enough, in which case those without sessions are
+    # stopped. The usage is kept in Firestore, so it doesn't matter which process (if any) ran the last batch.
+    if INSTANCE_IDLE_STOP_SECONDS <= 0 or datetime.now(timezone.utc) < idle_deadline(
+        remote_network_tag
+    ):
+        return False
+    # The idle check needs the firewall rule to reach the hubs, so it runs in a session of its own.
+    with ComputeSession(remote_network_tag, idle_check=True) as session:
+        session.stop_idle_instances()
+    return True
+
+
+def scheduled_idle_check(remote_network_tag):
+    try:
+        check_idle_instances(remote_network_tag)
+    except Exception:
+        traceback.print_exc()
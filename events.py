@@ -0,0 +1,64 @@
+from collections import deque
+from os import getenv
+from threading import Condition
+from time import monotonic
+
+# Number of recent events kept in memory for subscribers that connect late or reconnect.
+EVENT_BUFFER_SIZE = int(getenv("EVENT_BUFFER_SIZE", "1000"))
+# Seconds between keepalives on idle event streams, so that proxies don't close them.
+EVENT_KEEPALIVE_SECONDS = float(getenv("EVENT_KEEPALIVE_SECONDS", "15"))
+# Streams that never end on their own are closed after this many seconds, so that they don't hold a worker for good.
+# EventSource reconnects and picks up after the last event it saw.
+EVENT_STREAM_SECONDS = float(getenv("EVENT_STREAM_SECONDS", "300"))
+
+
+class EventBus:
+    def __init__(self, capacity):
+        self.events = deque(maxlen=capacity)
+        self.sequence = 0
+        self.condition = Condition()
+
+    def publish(self, stream, kind, data):
+        with self.condition:
+            self.sequence += 1
+            self.events.append(
+                {"id": self.sequence, "stream": stream, "event": kind, "data": data}
+            )
+            self.condition.notify_all()
+
+    def published(self, stream):
+        with self.condition:
+            return any(event["stream"] == stream for event in self.events)
+
+    def pending(self, after, stream):
+        return [
+            event
+            for event in self.events
+            if event["id"] > after and stream in (None, event["stream"])
+        ]
+
+    def subscribe(self, stream=None, after=0, seconds=None):
+        # Yields the events of one stream (or of every stream) published after the given id as they come in, and
+        # None whenever EVENT_KEEPALIVE_SECONDS pass without any. The events of a stream end with a "done" event, and
+        # any subscription ends after the given number of seconds.
+        deadline = None if seconds is None else monotonic() + seconds
+        while deadline is None or monotonic() < deadline:
+            with self.condition:
+                events = self.pending(after, stream)
+                if not events:
+                    self.condition.wait(
+                        EVENT_KEEPALIVE_SECONDS
+                        if deadline is None
+                        else min(EVENT_KEEPALIVE_SECONDS, deadline - monotonic())
+                    )
+                    events = self.pending(after, stream)
+            if not events:
+                yield None
+            for event in events:
+                after = event["id"]
+                yield event
+                if stream is not None and event["event"] == "done":
+                    return
+
+
+event_bus = EventBus(EVENT_BUFFER_SIZE)
@@ -0,0 +1,125 @@
+import traceback
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from hashlib import sha256
+from os import getenv
+from threading import Event
+from threading import Thread
+from time import monotonic
+from time import sleep
+
+from clients import collection
+from clients import firestore_client
+from tracing import span
+
+IDEMPOTENCY_COLLECTION = "idempotency"
+# A repeated request within this many hours gets the response of the original one instead of running again.
+IDEMPOTENCY_TTL_HOURS = float(getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+# A repeated request that arrives while the original is still running polls for its response this often, and gives
+# up after IDEMPOTENCY_WAIT_SECONDS.
+IDEMPOTENCY_POLL_SECONDS = float(getenv("IDEMPOTENCY_POLL_SECONDS", "2"))
+IDEMPOTENCY_WAIT_SECONDS = float(getenv("IDEMPOTENCY_WAIT_SECONDS", "600"))
+# A running request renews its lease this often. A repeated request takes over once the lease has not been renewed for
+# IDEMPOTENCY_LEASE_SECONDS, e.g. because the instance running the original request was shut down.
+IDEMPOTENCY_HEARTBEAT_SECONDS = float(getenv("IDEMPOTENCY_HEARTBEAT_SECONDS", "30"))
+IDEMPOTENCY_LEASE_SECONDS = float(getenv("IDEMPOTENCY_LEASE_SECONDS", "120"))
+
+
+class IdempotencyException(Exception):
+    def __init__(self, message, exception):
+        self.message = message
+        self.exception = exception
+
+    def __str__(self):
+        return f"IdempotencyException: {self.message}\n{self.exception}"
+
+
+def lease_expired(record, now):
+    return record["status"] == "running" and record.get(
+        "heartbeat", record["created"]
+    ) < now - timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS)
+
+
+def claim(reference, fingerprint):
+    # Returns None if this request gets to run, otherwise the record of the request that did.
+    from google.api_core.exceptions import Conflict
+    from google.api_core.exceptions import FailedPrecondition
+
+    now = datetime.now(timezone.utc)
+    record = {
+        "status": "running",
+        "fingerprint": fingerprint,
+        "created": now,
+        "heartbeat": now,
+    }
+    try:
+        with span("firestore.write idempotency"):
+            reference.create(record)
+        return None
+    except Conflict:
+        pass
+    with span("firestore.read idempotency"):
+        snapshot = reference.get()
+    if not snapshot.exists:
+        # The original request failed, so this one runs from scratch unless another retry claims it first.
+        return claim(reference, fingerprint)
+    expired = snapshot.get("created") < now - timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+    if not expired and snapshot.get("fingerprint") != fingerprint:
+        raise IdempotencyException(
+            "Idempotency key was reused for a different request!", None
+        )
+    if not expired and not lease_expired(snapshot.to_dict(), now):
+        return snapshot
+    # Only one of several repeated requests gets to take over.
+    try:
+        with span("firestore.write idempotency"):
+            reference.update(
+                record,
+                option=firestore_client().write_option(
+                    last_update_time=snapshot.update_time
+                ),
+            )
+    except FailedPrecondition:
+        return claim(reference, fingerprint)
+    return None
+
+
+def renew_lease(reference, done):
+    while not done.wait(IDEMPOTENCY_HEARTBEAT_SECONDS):
+        try:
+            with span("firestore.write idempotency"):
+                reference.update({"heartbeat": datetime.now(timezone.utc)})
+        except Exception:
+            traceback.print_exc()
+
+
+def run_once(idempotency_key, fingerprint, f):
+    # f returns a JSON body and a status code, which are stored so that repeated requests can be answered with them.
+    reference = collection(IDEMPOTENCY_COLLECTION).document(
+        sha256(idempotency_key.encode()).hexdigest()
+    )
+    deadline = monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        snapshot = claim(reference, fingerprint)
+        if snapshot is None:
+            done = Event()
+            Thread(target=renew_lease, args=(reference, done), daemon=True).start()
+            try:
+                (body, status) = f()
+            except Exception:
+                # Let a retry run the request again.
+                reference.delete()
+                raise
+            finally:
+                done.set()
+            with span("firestore.write idempotency"):
+                reference.update({"status": "done", "body": body, "code": status})
+            return (body, status)
+        if snapshot.get("status") == "done":
+            return (snapshot.get("body"), snapshot.get("code"))
+        if monotonic() > deadline:
+            raise IdempotencyException(
+                "Timed out waiting for the original request!", None
+            )
+        sleep(IDEMPOTENCY_POLL_SECONDS)
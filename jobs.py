@@ -0,0 +1,49 @@
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+from threading import BoundedSemaphore
+
+RELOAD_JOB_WORKERS = int(getenv("RELOAD_JOB_WORKERS", "1"))
+RELOAD_JOB_QUEUE_DEPTH = int(getenv("RELOAD_JOB_QUEUE_DEPTH", "4"))
+
+
+class JobQueueFullException(Exception):
+    def __init__(self, capacity):
+        self.capacity = capacity
+
+    def __str__(self):
+        return f"JobQueueFullException: All {self.capacity} job slots are in use!"
+
+
+def log_job_failure(future):
+    if future.exception() is not None:
+        traceback.print_exception(
+            type(future.exception()),
+            future.exception(),
+            future.exception().__traceback__,
+        )
+
+
+class JobQueue:
+    def __init__(self, workers, queue_depth):
+        # Slots cover both running and waiting jobs so the executor's own queue stays bounded.
+        self.capacity = workers + queue_depth
+        self.slots = BoundedSemaphore(self.capacity)
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="reload-job"
+        )
+
+    def submit(self, f, *args, **kwds):
+        if not self.slots.acquire(blocking=False):
+            raise JobQueueFullException(self.capacity)
+        try:
+            future = self.executor.submit(f, *args, **kwds)
+        except Exception:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda _: self.slots.release())
+        future.add_done_callback(log_job_failure)
+        return future
+
+
+job_queue = JobQueue(RELOAD_JOB_WORKERS, RELOAD_JOB_QUEUE_DEPTH)
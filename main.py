@@ -1,32 +1,69 @@
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timedelta
 from datetime import timezone
+from functools import wraps
+from hashlib import sha256
+from json import dumps
+from math import ceil
+from os import getenv
 from secrets import get_card_names
 from secrets import get_cards
 from secrets import get_credentials
 from secrets import SecurityException
 from sys import argv
+from threading import Lock
+from time import perf_counter
 from time import sleep
 
 from flask import Flask
 from flask import jsonify
+from flask import make_response
 from flask import render_template
 from flask import request
-from google.cloud import firestore
+from flask import Response
+from flask import url_for
 from werkzeug.exceptions import BadRequest
+from werkzeug.exceptions import Conflict
+from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.exceptions import TooManyRequests
 
-from amazon_balance_reloader import AmazonBalanceReloaderException
-from amazon_balance_reloader import LocalAmazonBalanceReloader
-from amazon_balance_reloader import RemoteAmazonBalanceReloader
-from compute_session import ComputeSession
-from compute_session import ComputeSessionException
-from compute_session import is_app_engine_environment
-from compute_session import MockComputeSession
-from compute_session import project_id
+from clients import collection
+from clients import firestore_client
+from clients import is_app_engine_environment
+from clients import lazy_import
+from clients import project_id
+from coalescing import batch_coalescer
+from events import event_bus
+from events import EVENT_STREAM_SECONDS
+from idempotency import IdempotencyException
+from idempotency import run_once
+from jobs import job_queue
+from jobs import JobQueueFullException
+from metrics import batches_in_flight
+from metrics import card_errors
+from metrics import card_reloads
+from metrics import exposition
+from metrics import rate_limited_requests
+from rate_limit import rate_limiter
+from rollups import due_cards
+from rollups import rollup_summary
+from rollups import write_transaction
+from session_cache import load_cookies
+from session_cache import save_cookies
+from session_cache import SESSION_CACHE_ENABLED
+from session_cache import SessionCacheException
+from static_bundle import load_manifest
+from tracing import span
+from tracing import Trace
+from tracing import traced
 
 app = Flask(__name__)
-db = firestore.Client()
+# Only batches need selenium and the Compute API, so the dashboard never pays for importing them.
+amazon_balance_reloader = lazy_import("amazon_balance_reloader")
+compute_session = lazy_import("compute_session")
 
 
 def gae_dashboard_url():
@@ -46,120 +83,815 @@ def cloud_log_url(start, end):
     )
 
 
+TRANSACTIONS_PAGE_SIZE = int(getenv("TRANSACTIONS_PAGE_SIZE", "25"))
+MAX_TRANSACTIONS_PAGE_SIZE = 100
+
+
+def format_spans(spans):
+    extent = max((entry["start"] + entry["duration"] for entry in spans), default=0)
+    return [
+        {
+            **entry,
+            "offset": entry["start"] / (extent or 1) * 100,
+            # Keep instantaneous spans visible in the waterfall.
+            "width": max(entry["duration"] / (extent or 1) * 100, 0.5),
+            "duration_str": f'{entry["duration"] / 1000:.2f} seconds',
+        }
+        for entry in spans
+    ]
+
+
+def format_browser_usage(transaction):
+    if not transaction.get("browser_usage"):
+        return None
+    usage = transaction["browser_usage"]
+    return (
+        f'{transaction["browser_profile"].capitalize()} browser profile: '
+        f'{usage["bytes_transferred"] / 1024:,.0f} KiB transferred, '
+        f'{usage["peak_js_heap_bytes"] / 1024 / 1024:,.1f} MiB peak JS heap'
+    )
+
+
+def format_transaction(transaction):
+    return {
+        "timestamp": transaction["timestamp_start"].timestamp() * 1000,
+        "timestamp_str": transaction["timestamp_start"].strftime("%x %X (UTC)"),
+        "time_elapsed": (
+            transaction["timestamp_end"] - transaction["timestamp_start"]
+        ).total_seconds()
+        * 1000,
+        "time_elapsed_str": f'{round((transaction["timestamp_end"] - transaction["timestamp_start"]).total_seconds())} seconds',
+        "app_engine_url": transaction["app_engine"] and gae_dashboard_url(),
+        "compute_engine_url": transaction["compute_instance_webdriver"]
+        and compute_instances_url(),
+        "log_url": cloud_log_url(
+            transaction["timestamp_start"], transaction["timestamp_end"]
+        )
+        if transaction["app_engine"]
+        else None,
+        "cards": transaction["cards"],
+        "amount": "${:,.2f}".format(transaction["amount"]),
+        "success": transaction["success"],
+        "spans": format_spans(transaction.get("spans", [])),
+        "browser_usage": format_browser_usage(transaction),
+        "message": f'Some cards failed to reload: { ", ".join(cs[0] for cs in zip(transaction["cards"], transaction["success"]) if not cs[1]) }'
+        if True in transaction["success"] and False in transaction["success"]
+        else f'Successfully reloaded {len(transaction["cards"])} cards!'
+        if True in transaction["success"]
+        else f'Failed to reload {len(transaction["cards"])} cards!',
+    }
+
+
+def transaction_page(page_size, after=None, before=None):
+    from google.cloud import firestore
+
+    transactions = collection("transactions")
+    cursor = after or before
+    if cursor:
+        with span("firestore.read transactions"):
+            cursor_snapshot = transactions.document(cursor).get()
+        if not cursor_snapshot.exists:
+            raise BadRequest()
+    # Paging backwards walks the index in ascending order from the cursor and flips the result.
+    query = transactions.order_by(
+        "timestamp_end",
+        direction=firestore.Query.ASCENDING if before else firestore.Query.DESCENDING,
+    )
+    if cursor:
+        query = query.start_after(cursor_snapshot)
+    # Fetch one extra document to find out whether another page exists in this direction.
+    with span("firestore.read transactions"):
+        snapshots = list(query.limit(page_size + 1).stream())
+    has_more = len(snapshots) > page_size
+    snapshots = snapshots[:page_size]
+    if before:
+        snapshots.reverse()
+    return {
+        "transactions": [
+            format_transaction(snapshot.to_dict()) for snapshot in snapshots
+        ],
+        "prev_cursor": snapshots[0].id
+        if snapshots and (after or (before and has_more))
+        else None,
+        "next_cursor": snapshots[-1].id if snapshots and (before or has_more) else None,
+        "page_size": page_size,
+    }
+
+
+def dashboard_etag():
+    # The dashboard only changes when a transaction finishes, the day rolls over (see rollup_summary) or the app is
+    # redeployed. Transactions gain their timestamp_end last, so the latest one is also the last one written.
+    from google.cloud import firestore
+
+    with span("firestore.read latest transaction"):
+        latest = next(
+            iter(
+                collection("transactions")
+                .order_by("timestamp_end", direction=firestore.Query.DESCENDING)
+                .limit(1)
+                .stream()
+            ),
+            None,
+        )
+    return sha256(
+        "\n".join(
+            [
+                request.full_path,
+                str(latest and latest.update_time),
+                datetime.now(timezone.utc).strftime("%Y-%m-%d"),
+                getenv("GAE_DEPLOYMENT_ID", ""),
+                load_manifest().get("bundle.css", ""),
+            ]
+        ).encode()
+    ).hexdigest()
+
+
+@app.context_processor
+def static_assets():
+    def asset(name):
+        # Fingerprinted files from static_bundle.py, or the originals when it hasn't been run.
+        manifest = load_manifest()
+        return url_for(
+            "static", filename=f"dist/{manifest[name]}" if name in manifest else name
+        )
+
+    return {"asset": asset, "bundled": "bundle.css" in load_manifest()}
+
+
 @app.route("/")
 def index():
-    transactions = [
-        transaction.to_dict() for transaction in db.collection("transactions").stream()
-    ]
-    transactions.sort(
-        key=lambda transaction: transaction["timestamp_end"], reverse=True
+    page_size = request.args.get("pageSize", TRANSACTIONS_PAGE_SIZE, int)
+    if not 0 < page_size <= MAX_TRANSACTIONS_PAGE_SIZE:
+        raise BadRequest()
+    etag = dashboard_etag()
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = make_response(
+            render_template(
+                "status.html",
+                **transaction_page(
+                    page_size, request.args.get("after"), request.args.get("before")
+                ),
+                summary=rollup_summary(),
+                # App Engine buffers streamed responses, so live updates are opt-in where they work at all.
+                live_events=request.args.get("live", False, is_truthy)
+                and not is_app_engine_environment(),
+            )
+        )
+    response.set_etag(etag)
+    # Browsers may keep the page, but have to check that it's still current.
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+
+RELOAD_SESSIONS = int(getenv("RELOAD_SESSIONS", "1"))
+# Attempts per card, with a backoff that doubles after every attempt, and new browser sessions per batch session.
+RELOAD_MAX_ATTEMPTS = int(getenv("RELOAD_MAX_ATTEMPTS", "3"))
+RELOAD_RETRY_BACKOFF_SECONDS = float(getenv("RELOAD_RETRY_BACKOFF_SECONDS", "2"))
+RELOAD_MAX_RECONNECTS = int(getenv("RELOAD_MAX_RECONNECTS", "2"))
+# Error classes (see amazon_balance_reloader.error_class) that are retried in the same browser session.
+RETRYABLE_ERRORS = ("timeout", "element")
+# Days after its last successful reload that a card is due again, see /reloadDue.
+MAX_IDLE_DAYS = float(getenv("MAX_IDLE_DAYS", "30"))
+# Minutes that /standby keeps selenium instances running for.
+WARM_STANDBY_MINUTES = float(getenv("WARM_STANDBY_MINUTES", "15"))
+MAX_RELOAD_SESSIONS = int(getenv("MAX_RELOAD_SESSIONS", "4"))
+
+
+@traced("browser.launch")
+def open_reloader(host):
+    return (
+        amazon_balance_reloader.RemoteAmazonBalanceReloader(f"{host}:4444")
+        if host
+        else amazon_balance_reloader.LocalAmazonBalanceReloader()
     )
-    transactions = [
-        {
-            "timestamp": transaction["timestamp_start"].timestamp() * 1000,
-            "timestamp_str": transaction["timestamp_start"].strftime("%x %X (UTC)"),
-            "time_elapsed": (
-                transaction["timestamp_end"] - transaction["timestamp_start"]
-            ).total_seconds()
-            * 1000,
-            "time_elapsed_str": f'{round((transaction["timestamp_end"] - transaction["timestamp_start"]).total_seconds())} seconds',
-            "app_engine_url": transaction["app_engine"] and gae_dashboard_url(),
-            "compute_engine_url": transaction["compute_instance_webdriver"]
-            and compute_instances_url(),
-            "log_url": cloud_log_url(
-                transaction["timestamp_start"], transaction["timestamp_end"]
+
+
+def authenticate(reloader, credentials, session_key, record_session):
+    if session_key is None:
+        reloader.authenticate(credentials["username"], credentials["password"])
+        return
+    reloader.keep_session = True
+    try:
+        cookies = load_cookies(session_key)
+    except SessionCacheException:
+        cookies = None
+        traceback.print_exc()
+    if cookies and reloader.restore_session(cookies):
+        record_session("hits")
+        return
+    record_session("misses")
+    reloader.authenticate(credentials["username"], credentials["password"])
+    try:
+        save_cookies(session_key, reloader.session_cookies())
+    except SessionCacheException:
+        traceback.print_exc()
+
+
+def reload_pending(reloader, cards, amount, record, record_attempt):
+    # Reloads cards in order, retrying failures that may pass with a backoff. Evaluates to the cards that are left
+    # once the browser session dies.
+    for (position, (index, (name, card))) in enumerate(cards):
+        while True:
+            attempts = record_attempt(index)
+            try:
+                with span(f"browser.reload {name}", "browser.reload"):
+                    reloader.reload(card, amount)
+                record(index, True)
+                break
+            except amazon_balance_reloader.AmazonBalanceReloaderException as inst:
+                traceback.print_exc()
+                error = amazon_balance_reloader.error_class(inst)
+            if reloader.submitted:
+                # The order may have gone through, so retrying could charge the card twice.
+                record(index, False, error="unconfirmed")
+                break
+            if attempts >= RELOAD_MAX_ATTEMPTS:
+                record(index, False, error=error)
+                if error == "driver":
+                    return cards[position + 1 :]
+                break
+            if error == "driver":
+                return cards[position:]
+            if error not in RETRYABLE_ERRORS:
+                record(index, False, error=error)
+                break
+            sleep(RELOAD_RETRY_BACKOFF_SECONDS * 2 ** (attempts - 1))
+    return []
+
+
+def reload_cards(
+    session,
+    host,
+    credentials,
+    cards,
+    amount,
+    record,
+    record_attempt,
+    session_key,
+    record_session,
+    record_usage,
+    publish,
+):
+    # A browser session that dies is replaced by a new one, which picks up where the old one left off.
+    pending = cards
+    for reconnect in range(RELOAD_MAX_RECONNECTS + 1):
+        try:
+            reloader = open_reloader(host)
+        except amazon_balance_reloader.AmazonBalanceReloaderException:
+            # The instance may have been stopped or replaced since it was discovered.
+            session.invalidate_remote_ips()
+            session.invalidate_firewall_rule()
+            session.mark_unhealthy(host)
+            traceback.print_exc()
+            for (index, _) in pending:
+                record(index, False, overwrite=False, error="launch")
+            return
+        publish("session_opened", cards=len(pending), reconnect=reconnect)
+        authenticated = False
+        try:
+            with reloader:
+                authenticate(reloader, credentials, session_key, record_session)
+                authenticated = True
+                publish("authenticated", cards=len(pending))
+                pending = reload_pending(
+                    reloader, pending, amount, record, record_attempt
+                )
+        except amazon_balance_reloader.AmazonBalanceReloaderException as inst:
+            traceback.print_exc()
+            if (
+                not authenticated
+                and amazon_balance_reloader.error_class(inst) != "driver"
+            ):
+                for (index, _) in pending:
+                    record(index, False, overwrite=False, error="auth")
+                return
+        finally:
+            record_usage(reloader.usage)
+        if not pending:
+            return
+    for (index, _) in pending:
+        record(index, False, overwrite=False, error="driver")
+
+
+def reload_batch(
+    credentials,
+    cards,
+    amount,
+    transaction=None,
+    sessions=1,
+    session_key=None,
+    trace=None,
+):
+    trace = trace or Trace()
+    batches_in_flight.inc()
+    try:
+        with trace.activate():
+            return traced_reload_batch(
+                credentials, cards, amount, transaction, sessions, session_key, trace
             )
-            if transaction["app_engine"]
-            else None,
-            "cards": transaction["cards"],
-            "amount": "${:,.2f}".format(transaction["amount"]),
-            "success": transaction["success"],
-            "message": f'Some cards failed to reload: { ", ".join(cs[0] for cs in zip(transaction["cards"], transaction["success"]) if not cs[1]) }'
-            if True in transaction["success"] and False in transaction["success"]
-            else f'Successfully reloaded {len(transaction["cards"])} cards!'
-            if True in transaction["success"]
-            else f'Failed to reload {len(transaction["cards"])} cards!',
-        }
-        for transaction in transactions
-    ]
-    return render_template("status.html", transactions=transactions)
+    finally:
+        batches_in_flight.dec()
 
 
-def reload_batch(credentials, cards, amount):
+def traced_reload_batch(
+    credentials, cards, amount, transaction, sessions, session_key, trace
+):
+    # The transaction document is written up front and updated per card so that job status can be polled.
+    # It only gains a timestamp_end (and thereby shows up on the dashboard) once the batch has finished.
+    transaction = transaction or collection("transactions").document()
     result = {
         "timestamp_start": datetime.now(timezone.utc),
-        "app_engine": is_app_engine_environment(),
-        "compute_instance_webdriver": is_app_engine_environment()
+        "app_engine": compute_session.is_app_engine_environment(),
+        "compute_instance_webdriver": compute_session.is_app_engine_environment()
         or "--compute-instance-webdriver" in argv,
         "cards": list(cards.keys()),
         "amount": amount,
-        "success": [],
-        "timestamp_end": None,
+        # Pending cards are None so that parallel sessions can fill in results out of order.
+        "success": [None] * len(cards),
+        # Attempts per card and the error class of its last failure.
+        "checkpoints": [{"attempts": 0, "error": None} for _ in cards],
+        "sessions": max(1, min(sessions, len(cards))),
+        "session_cache": {"hits": 0, "misses": 0} if session_key else None,
+        "status": "running",
+        "browser_profile": amazon_balance_reloader.BROWSER_PROFILE,
+        "browser_usage": {"bytes_transferred": 0, "peak_js_heap_bytes": 0},
+        # Seconds from starting a stopped selenium instance until its hub was ready, None if one was already running.
+        "backend_boot_seconds": None,
     }
+    with span("firestore.write transaction"):
+        transaction.set(result)
+    progress_lock = Lock()
+    # perf_counter of the first attempt per card.
+    card_starts = {}
+
+    def publish(kind, **data):
+        event_bus.publish(transaction.id, kind, data)
+
+    publish("started", total=len(cards), sessions=result["sessions"])
+
+    def record(index, success, overwrite=True, error=None):
+        with progress_lock:
+            if overwrite or result["success"][index] is None:
+                result["success"][index] = success
+                result["checkpoints"][index]["error"] = error
+                with span("firestore.write progress"):
+                    transaction.update(
+                        {
+                            "success": result["success"],
+                            "checkpoints": result["checkpoints"],
+                        }
+                    )
+                card_reloads.inc(
+                    card=result["cards"][index],
+                    outcome="success" if success else "failure",
+                )
+                if not success:
+                    card_errors.inc(error=error)
+                publish(
+                    "card",
+                    index=index,
+                    success=success,
+                    error=error,
+                    attempts=result["checkpoints"][index]["attempts"],
+                    seconds=perf_counter() - card_starts[index]
+                    if index in card_starts
+                    else None,
+                )
+
+    def record_attempt(index):
+        with progress_lock:
+            card_starts.setdefault(index, perf_counter())
+            result["checkpoints"][index]["attempts"] += 1
+            return result["checkpoints"][index]["attempts"]
+
+    def record_session(outcome):
+        with progress_lock:
+            result["session_cache"][outcome] += 1
+
+    def record_usage(usage):
+        # Sessions run side by side, so bytes add up while the peak heap is that of the largest session.
+        with progress_lock:
+            result["browser_usage"]["bytes_transferred"] += usage.bytes_transferred
+            result["browser_usage"]["peak_js_heap_bytes"] = max(
+                result["browser_usage"]["peak_js_heap_bytes"], usage.peak_js_heap_bytes
+            )
+
     try:
-        if not result["compute_instance_webdriver"]:
-            pass
-        with ComputeSession("standalone-chrome") if result[
+        with compute_session.ComputeSession("standalone-chrome") if result[
             "compute_instance_webdriver"
-        ] else MockComputeSession("127.0.0.1") as session:
-            with RemoteAmazonBalanceReloader(f"{session.remote_ip()}:4444") if result[
-                "compute_instance_webdriver"
-            ] else LocalAmazonBalanceReloader() as reloader:
-                reloader.authenticate(credentials["username"], credentials["password"])
-                for card in cards.values():
-                    try:
-                        reloader.reload(card, amount)
-                        result["success"].append(True)
-                    except AmazonBalanceReloaderException:
-                        result["success"].append(False)
-                        traceback.print_exc()
-    except (ComputeSessionException, AmazonBalanceReloaderException):
-        result["success"].extend([False] * (len(cards) - len(result["success"])))
+        ] else compute_session.MockComputeSession(None) as session:
+            hosts = session.select_backends(result["sessions"])
+            result["backend_boot_seconds"] = session.boot_seconds
+            indexed_cards = list(enumerate(cards.items()))
+            # Cards are dealt round-robin so that every session gets an even share of the batch.
+            with ThreadPoolExecutor(
+                max_workers=result["sessions"], thread_name_prefix="reload-session"
+            ) as executor:
+                for future in [
+                    executor.submit(
+                        trace.bind(reload_cards),
+                        session,
+                        hosts[i],
+                        credentials,
+                        indexed_cards[i :: result["sessions"]],
+                        amount,
+                        record,
+                        record_attempt,
+                        session_key,
+                        record_session,
+                        record_usage,
+                        publish,
+                    )
+                    for i in range(result["sessions"])
+                ]:
+                    future.result()
+    except compute_session.ComputeSessionException:
         traceback.print_exc()
+        for index in range(len(cards)):
+            record(index, False, overwrite=False, error="compute")
+    result["success"] = [success is True for success in result["success"]]
     result["timestamp_end"] = datetime.now(timezone.utc)
-    db.collection("transactions").add(result)
+    result["status"] = "done"
+    result["spans"] = trace.spans
+    write_transaction(transaction, result)
+    publish("done", **completion(result))
     return result
 
 
-def validate_and_reload_batch(key, cards, amount):
+def completion(transaction):
+    return {
+        "success": transaction["success"],
+        "seconds": (
+            transaction["timestamp_end"] - transaction["timestamp_start"]
+        ).total_seconds(),
+    }
+
+
+def client_address():
+    # App Engine passes the address of the client in a header that it overwrites, anywhere else clients could set it
+    # themselves to get a fresh bucket with every request.
+    if is_app_engine_environment():
+        return request.headers.get("X-Appengine-User-Ip", request.remote_addr)
+    return request.remote_addr
+
+
+def validate_key(key):
+    # Invalid keys lock the client out for longer and longer to mitigate brute-force key attacks, see rate_limited.
+    try:
+        credentials = get_credentials(key)
+    except SecurityException:
+        rate_limiter.record(client_address(), valid=False)
+        raise BadRequest()
+    rate_limiter.record(client_address(), valid=True)
+    return credentials
+
+
+def validate_batch(key, cards, amount):
     if (
         amount <= 0
         or len(cards) == 0
         or False in [card in get_card_names() for card in cards]
     ):
         raise BadRequest()
-    try:
-        return reload_batch(
-            get_credentials(key),
+    # Credentials and cards are decrypted together, so a valid key reads both.
+    credentials = validate_key(key)
+    return (
+        credentials,
+        {name: number for (name, number) in get_cards(key).items() if name in cards},
+    )
+
+
+def session_cache_key(key):
+    return key if SESSION_CACHE_ENABLED else None
+
+
+def validate_and_reload_batch(key, cards, amount, sessions=1):
+    trace = Trace()
+    with trace.activate():
+        credentials, cards = validate_batch(key, cards, amount)
+    # Overlapping requests for the same account and amount share one browser session, and thereby never charge a card
+    # twice or fight over the firewall rule.
+    return batch_coalescer.run(
+        (sha256(key.encode()).hexdigest(), amount),
+        cards,
+        sessions,
+        lambda cards, sessions: reload_batch(
+            credentials,
+            cards,
+            amount,
+            sessions=sessions,
+            session_key=session_cache_key(key),
+            trace=trace,
+        ),
+    )
+
+
+def is_truthy(value):
+    return value.lower() in ("1", "true", "yes")
+
+
+def enqueue_reload_batch(key, cards, amount, sessions=1):
+    trace = Trace()
+    with trace.activate():
+        credentials, cards = validate_batch(key, cards, amount)
+    transaction = collection("transactions").document()
+    with span("firestore.write transaction"):
+        transaction.set(
             {
-                name: number
-                for (name, number) in get_cards(key).items()
-                if name in cards
-            },
+                "cards": list(cards.keys()),
+                "amount": amount,
+                "success": [None] * len(cards),
+                "status": "queued",
+            }
+        )
+    event_bus.publish(transaction.id, "queued", {"total": len(cards)})
+    try:
+        job_queue.submit(
+            reload_batch,
+            credentials,
+            cards,
             amount,
+            transaction,
+            sessions,
+            session_cache_key(key),
+            trace,
         )
-    except SecurityException:
-        # Block for 5 seconds to mitigate brute-force key attacks.
-        sleep(5)
+    except JobQueueFullException:
+        transaction.delete()
+        event_bus.publish(transaction.id, "done", {})
+        traceback.print_exc()
+        raise ServiceUnavailable()
+    return (
+        jsonify({"job": transaction.id, "url": url_for("job", job_id=transaction.id)}),
+        202,
+    )
+
+
+def batch_response(key, cards, amount):
+    sessions = request.args.get("sessions", RELOAD_SESSIONS, int)
+    if not 0 < sessions <= MAX_RELOAD_SESSIONS:
         raise BadRequest()
+    if request.args.get("job", False, is_truthy) or request.args.get(
+        "stream", False, is_truthy
+    ):
+        return enqueue_reload_batch(key, cards, amount, sessions)
+    return jsonify(
+        {**validate_and_reload_batch(key, cards, amount, sessions), "cards": None}
+    )
+
+
+def idempotent(f):
+    # Requests carrying an Idempotency-Key header (or idempotencyKey parameter) run once, and repeating them returns
+    # the response of the original run.
+    @wraps(f)
+    def wrapper(*args, **kwds):
+        idempotency_key = request.headers.get(
+            "Idempotency-Key", request.args.get("idempotencyKey")
+        )
+        if not idempotency_key:
+            return f(*args, **kwds)
+        key = request.args.get("key", "")
+        # Stored responses are only handed out to callers that know the secret key.
+        validate_key(key)
+        fingerprint = sha256(
+            "\n".join(
+                [key, request.path]
+                + sorted(
+                    f"{name}={value}"
+                    for (name, value) in request.args.items(multi=True)
+                    if name not in ("key", "idempotencyKey")
+                )
+            ).encode()
+        ).hexdigest()
+
+        def respond():
+            response = make_response(f(*args, **kwds))
+            return (response.get_json(), response.status_code)
+
+        try:
+            (body, status) = run_once(idempotency_key, fingerprint, respond)
+        except IdempotencyException:
+            traceback.print_exc()
+            raise Conflict()
+        return jsonify(body), status
+
+    return wrapper
+
+
+def server_sent_events(events):
+    for event in events:
+        if event is None:
+            yield ": keepalive\n\n"
+            continue
+        if event["id"] is not None:
+            yield f'id: {event["id"]}\n'
+        yield f'event: {event["event"]}\ndata: {dumps({**event["data"], "job": event["stream"]})}\n\n'
+
+
+def event_response(events):
+    # The generator is consumed while the response is sent, so events reach the client as they are published.
+    return Response(
+        server_sent_events(events),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def last_event_id():
+    # Browsers send the id of the last event they saw when an EventSource reconnects.
+    return request.headers.get("Last-Event-ID", request.args.get("after", 0), int)
+
+
+def finished_event(snapshot):
+    if not snapshot.exists:
+        # The job was dropped before it ran, see enqueue_reload_batch.
+        return {"id": None, "stream": snapshot.id, "event": "done", "data": {}}
+    transaction = snapshot.to_dict()
+    if transaction.get("status", "done") != "done":
+        return None
+    return {
+        "id": None,
+        "stream": snapshot.id,
+        "event": "done",
+        "data": completion(transaction),
+    }
+
+
+def job_events(reference, after):
+    # Only events published by this instance reach its event bus, so a job that runs (or ran) elsewhere ends its
+    # stream once its transaction says it's done.
+    event = (
+        None if event_bus.published(reference.id) else finished_event(reference.get())
+    )
+    if event:
+        yield event
+        return
+    for event in event_bus.subscribe(reference.id, after):
+        finished = event is None and finished_event(reference.get())
+        if finished:
+            yield finished
+            return
+        yield event
+
+
+def streamable(f):
+    # With stream=true, a batch runs as a job and the response streams its events instead of returning the job id.
+    @wraps(f)
+    def wrapper(*args, **kwds):
+        if not request.args.get("stream", False, is_truthy):
+            return f(*args, **kwds)
+        response = make_response(f(*args, **kwds))
+        if response.status_code != 202:
+            return response
+        return event_response(
+            job_events(
+                collection("transactions").document(response.get_json()["job"]), 0
+            )
+        )
+
+    return wrapper
+
+
+def rate_limited(f):
+    # Throttled clients are turned away before anything reads secrets, and without holding up the worker.
+    @wraps(f)
+    def wrapper(*args, **kwds):
+        retry_after = rate_limiter.acquire(client_address())
+        if retry_after:
+            rate_limited_requests.inc()
+            raise TooManyRequests(retry_after=ceil(retry_after))
+        return f(*args, **kwds)
+
+    return wrapper
 
 
 @app.route("/reload")
+@rate_limited
+@streamable
+@idempotent
 def reload():
     key = request.args.get("key", "")
     cards = request.args.get("cards", "").split(",")
     amount = request.args.get("amount", 0, float)
-    return jsonify({**validate_and_reload_batch(key, cards, amount), "cards": None})
+    return batch_response(key, cards, amount)
 
 
 @app.route("/reloadAll")
+@rate_limited
+@streamable
+@idempotent
 def reload_all():
     key = request.args.get("key", "")
     amount = request.args.get("amount", 0, float)
+    return batch_response(key, get_card_names(), amount)
+
+
+@app.route("/reloadDue")
+@rate_limited
+@streamable
+@idempotent
+def reload_due():
+    key = request.args.get("key", "")
+    amount = request.args.get("amount", 0, float)
+    max_idle_days = request.args.get("maxIdleDays", MAX_IDLE_DAYS, float)
+    if amount <= 0 or max_idle_days < 0:
+        raise BadRequest()
+    cards = due_cards(get_card_names(), max_idle_days)
+    if not cards:
+        validate_key(key)
+        return jsonify({"status": "done", "cards": None, "success": []})
+    return batch_response(key, cards, amount)
+
+
+@app.route("/standby")
+@rate_limited
+def standby():
+    # Meant for a cron job shortly before scheduled batches: boots a selenium instance if none is running, and keeps
+    # it from being stopped for idleness for a while.
+    validate_key(request.args.get("key", ""))
+    minutes = request.args.get("minutes", WARM_STANDBY_MINUTES, float)
+    if minutes < 0:
+        raise BadRequest()
+    try:
+        compute_session.keep_warm("standalone-chrome", minutes * 60)
+        with compute_session.ComputeSession("standalone-chrome") as session:
+            hosts = session.select_backends(1)
+    except compute_session.ComputeSessionException:
+        traceback.print_exc()
+        raise ServiceUnavailable()
+    return jsonify({"ready": len(hosts), "boot_seconds": session.boot_seconds})
+
+
+@app.route("/stopIdle")
+@rate_limited
+def stop_idle():
+    # Meant for a cron job every few minutes: stops selenium instances that no batch has used for
+    # INSTANCE_IDLE_STOP_SECONDS and that aren't kept warm, whichever App Engine instance ran the last batch.
+    validate_key(request.args.get("key", ""))
+    try:
+        idle = compute_session.check_idle_instances("standalone-chrome")
+    except compute_session.ComputeSessionException:
+        traceback.print_exc()
+        raise ServiceUnavailable()
+    return jsonify({"idle": idle})
+
+
+@app.route("/jobs/<job_id>")
+def job(job_id):
+    with span("firestore.read job"):
+        snapshot = collection("transactions").document(job_id).get()
+    if not snapshot.exists:
+        raise NotFound()
+    transaction = snapshot.to_dict()
     return jsonify(
-        {**validate_and_reload_batch(key, get_card_names(), amount), "cards": None}
+        {
+            "job": job_id,
+            # Transactions written before job mode existed are always complete.
+            "status": transaction.get("status", "done"),
+            "completed": len(
+                [success for success in transaction["success"] if success is not None]
+            ),
+            "total": len(transaction["cards"]),
+            "success": transaction["success"],
+            "checkpoints": transaction.get("checkpoints"),
+            "timestamp_start": transaction.get("timestamp_start"),
+            "timestamp_end": transaction.get("timestamp_end"),
+        }
     )
 
 
+@app.route("/jobs/<job_id>/events")
+def job_event_stream(job_id):
+    reference = collection("transactions").document(job_id)
+    if not reference.get().exists:
+        raise NotFound()
+    return event_response(job_events(reference, last_event_id()))
+
+
+@app.route("/events")
+def events():
+    # Every batch that this instance runs, for the dashboard to show them while they are in flight.
+    if is_app_engine_environment():
+        raise NotFound()
+    return event_response(
+        event_bus.subscribe(None, last_event_id(), EVENT_STREAM_SECONDS)
+    )
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(exposition(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/_ah/warmup")
+def warmup():
+    # App Engine sends warmup requests to new instances before routing traffic to them.
+    firestore_client()
+    get_card_names()
+    return "", 204
+
+
 if __name__ == "__main__":
     app.run(host="127.0.0.1", port=8080, debug=True)
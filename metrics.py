@@ -0,0 +1,167 @@
+from bisect import bisect_left
+from threading import Lock
+from typing import Optional
+
+# Upper bounds in seconds, from a cached Firestore read up to a whole batch.
+DURATION_BUCKETS = [
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+    300,
+]
+
+registry = []
+
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(pairs):
+    if not pairs:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{label_value(value)}"' for (name, value) in pairs)
+        + "}"
+    )
+
+
+def format_number(value):
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+class Metric:
+    kind: Optional[str] = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        # Label values (in the order of self.labels) to the state of that series.
+        self.series = {}
+        self.lock = Lock()
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def exposition(self):
+        # Subclasses list their samples as (name, label pairs, value).
+        with self.lock:
+            samples = self.samples()
+        return "\n".join(
+            [
+                f"# HELP {self.name} {self.description}",
+                f"# TYPE {self.name} {self.kind}",
+            ]
+            + [
+                f"{name}{format_labels(pairs)} {format_number(value)}"
+                for (name, pairs, value) in samples
+            ]
+        )
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def samples(self):
+        # A series without labels is reported even before it is first incremented.
+        return [
+            (self.name, list(zip(self.labels, key)), value)
+            for (key, value) in sorted(self.series.items())
+        ] or ([(self.name, [], 0)] if not self.labels else [])
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, description, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        bucket = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                # Counts per bucket (the last one for values above every bound), sum and count.
+                series = self.series[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+            series[0][bucket] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        samples = []
+        for (key, (counts, total, count)) in sorted(self.series.items()):
+            pairs = list(zip(self.labels, key))
+            cumulative = 0
+            for (bound, bucket_count) in zip(self.buckets + [float("inf")], counts):
+                cumulative += bucket_count
+                samples.append(
+                    (
+                        f"{self.name}_bucket",
+                        pairs + [("le", format_number(bound))],
+                        cumulative,
+                    )
+                )
+            samples.append((f"{self.name}_sum", pairs, total))
+            samples.append((f"{self.name}_count", pairs, count))
+        return samples
+
+
+def exposition():
+    return "\n".join(metric.exposition() for metric in registry) + "\n"
+
+
+span_seconds = Histogram(
+    "balance_reloader_span_seconds",
+    "Duration of traced operations, i.e. every browser step and Compute, Firestore and HTTP call.",
+    ("span", "outcome"),
+)
+card_reloads = Counter(
+    "balance_reloader_card_reloads_total",
+    "Final result of every card in a batch.",
+    ("card", "outcome"),
+)
+card_errors = Counter(
+    "balance_reloader_card_errors_total",
+    "Error class of every card that failed to reload.",
+    ("error",),
+)
+security_exceptions = Counter(
+    "balance_reloader_security_exceptions_total",
+    "Secrets that failed to decrypt, mostly because of invalid keys.",
+)
+rate_limited_requests = Counter(
+    "balance_reloader_rate_limited_requests_total",
+    "Requests that were turned away with 429 Too Many Requests.",
+)
+batches_in_flight = Gauge(
+    "balance_reloader_batches_in_flight",
+    "Batches that are currently running.",
+)
@@ -0,0 +1,153 @@
+import traceback
+from collections import OrderedDict
+from functools import wraps
+from hashlib import sha256
+from os import getenv
+from threading import Lock
+from time import time
+
+from clients import collection
+from tracing import span
+
+# Requests that need the secret key draw a token from their client's bucket, which holds up to RATE_LIMIT_BURST
+# tokens and refills at RATE_LIMIT_PER_MINUTE.
+RATE_LIMIT_BURST = float(getenv("RATE_LIMIT_BURST", "10"))
+RATE_LIMIT_PER_MINUTE = float(getenv("RATE_LIMIT_PER_MINUTE", "10"))
+# Every invalid key locks its client out for twice as long as the previous one, until a valid key resets it.
+RATE_LIMIT_LOCKOUT_SECONDS = float(getenv("RATE_LIMIT_LOCKOUT_SECONDS", "5"))
+RATE_LIMIT_MAX_LOCKOUT_SECONDS = float(getenv("RATE_LIMIT_MAX_LOCKOUT_SECONDS", "3600"))
+# Least recently seen clients are forgotten beyond this many.
+RATE_LIMIT_MAX_CLIENTS = int(getenv("RATE_LIMIT_MAX_CLIENTS", "10000"))
+# Share lockouts across instances through Firestore, at the cost of a read per request.
+RATE_LIMIT_SHARED = getenv("RATE_LIMIT_SHARED", "").lower() in ("1", "true", "yes")
+RATE_LIMIT_COLLECTION = "rate_limits"
+
+
+class RateLimitException(Exception):
+    def __init__(self, message, exception):
+        self.message = message
+        self.exception = exception
+
+    def __str__(self):
+        return f"RateLimitException: {self.message}\n{self.exception}"
+
+
+def throwable(message):
+    def throwable(f):
+        @wraps(f)
+        def wrapper(*args, **kwds):
+            try:
+                return f(*args, **kwds)
+            except Exception as inst:
+                raise RateLimitException(message, inst)
+
+        return wrapper
+
+    return throwable
+
+
+class ClientState:
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated = now
+        self.failures = 0
+        self.locked_until = 0
+
+
+class RateLimiter:
+    def __init__(self, max_clients, burst, per_minute, lockout, max_lockout, shared):
+        self.max_clients = max_clients
+        self.burst = burst
+        self.per_minute = per_minute
+        self.lockout = lockout
+        self.max_lockout = max_lockout
+        self.shared = shared
+        # Ordered from least to most recently seen.
+        self.clients = OrderedDict()
+        self.lock = Lock()
+
+    def state(self, client, now):
+        # Callers hold self.lock.
+        state = self.clients.pop(client, None) or ClientState(self.burst, now)
+        self.clients[client] = state
+        while len(self.clients) > self.max_clients:
+            self.clients.popitem(last=False)
+        return state
+
+    @throwable("Failed to read the shared rate limit!")
+    def read_shared(self, client):
+        with span("firestore.read rate limit"):
+            snapshot = (
+                collection(RATE_LIMIT_COLLECTION)
+                .document(sha256(client.encode()).hexdigest())
+                .get()
+            )
+        return snapshot.to_dict() if snapshot.exists else None
+
+    @throwable("Failed to write the shared rate limit!")
+    def write_shared(self, client, state):
+        reference = collection(RATE_LIMIT_COLLECTION).document(
+            sha256(client.encode()).hexdigest()
+        )
+        with span("firestore.write rate limit"):
+            if state.failures:
+                reference.set(
+                    {"failures": state.failures, "locked_until": state.locked_until}
+                )
+            else:
+                reference.delete()
+
+    def acquire(self, client):
+        # Evaluates to the seconds that the client has to wait, or 0 once it has drawn a token.
+        now = time()
+        if self.shared:
+            try:
+                shared = self.read_shared(client)
+            except RateLimitException:
+                shared = None
+                traceback.print_exc()
+        with self.lock:
+            state = self.state(client, now)
+            if self.shared and shared:
+                state.failures = max(state.failures, shared["failures"])
+                state.locked_until = max(state.locked_until, shared["locked_until"])
+            state.tokens = min(
+                self.burst, state.tokens + (now - state.updated) * self.per_minute / 60
+            )
+            state.updated = now
+            if state.locked_until > now:
+                return state.locked_until - now
+            if state.tokens < 1:
+                return (1 - state.tokens) * 60 / self.per_minute
+            state.tokens -= 1
+            return 0
+
+    def record(self, client, valid):
+        with self.lock:
+            state = self.state(client, time())
+            if valid and not state.failures:
+                return
+            if valid:
+                state.failures = 0
+                state.locked_until = 0
+            else:
+                state.failures += 1
+                # The exponent is capped so that it can't overflow for persistent clients.
+                state.locked_until = time() + min(
+                    self.lockout * 2 ** min(state.failures - 1, 32), self.max_lockout
+                )
+        if self.shared:
+            try:
+                self.write_shared(client, state)
+            except RateLimitException:
+                traceback.print_exc()
+
+
+rate_limiter = RateLimiter(
+    RATE_LIMIT_MAX_CLIENTS,
+    RATE_LIMIT_BURST,
+    RATE_LIMIT_PER_MINUTE,
+    RATE_LIMIT_LOCKOUT_SECONDS,
+    RATE_LIMIT_MAX_LOCKOUT_SECONDS,
+    RATE_LIMIT_SHARED,
+)
@@ -0,0 +1,223 @@
+from argparse import ArgumentParser
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+from clients import collection
+from clients import firestore_client
+from tracing import span
+
+ROLLUP_COLLECTION = "rollups"
+CARDS_DOCUMENT = "cards"
+# Batch durations are counted into buckets by their upper bound in seconds, so percentiles can be read without
+# keeping every duration around. The last bucket collects everything slower.
+DURATION_BUCKETS = [15, 30, 60, 120, 300, 600, 1200]
+PERIODS = {"day": "%Y-%m-%d", "month": "%Y-%m"}
+# Transactions per write batch when backfilling, every transaction touches one document per period plus the cards.
+BACKFILL_BATCH_SIZE = 100
+
+
+def duration_bucket(seconds):
+    return next(
+        (str(bound) for bound in DURATION_BUCKETS if seconds <= bound),
+        "inf",
+    )
+
+
+def period_document(period, timestamp):
+    return f"{period}-{timestamp.astimezone(timezone.utc).strftime(PERIODS[period])}"
+
+
+def rollup_writes(transaction):
+    from google.cloud.firestore import Increment
+
+    duration = (
+        transaction["timestamp_end"] - transaction["timestamp_start"]
+    ).total_seconds()
+    successes = transaction["success"].count(True)
+    writes = {
+        period_document(period, transaction["timestamp_end"]): {
+            "period": period,
+            "key": transaction["timestamp_end"]
+            .astimezone(timezone.utc)
+            .strftime(PERIODS[period]),
+            "runs": Increment(1),
+            "cards": Increment(len(transaction["cards"])),
+            "successes": Increment(successes),
+            "failures": Increment(len(transaction["cards"]) - successes),
+            "duration_seconds": Increment(duration),
+            "durations": {duration_bucket(duration): Increment(1)},
+        }
+        for period in PERIODS
+    }
+    writes[CARDS_DOCUMENT] = {
+        "cards": {
+            name: {
+                "runs": Increment(1),
+                "successes": Increment(1 if success else 0),
+                "failures": Increment(0 if success else 1),
+                "last_success"
+                if success
+                else "last_failure": transaction["timestamp_end"],
+                "last_result": success,
+            }
+            for (name, success) in zip(transaction["cards"], transaction["success"])
+        }
+    }
+    return writes
+
+
+def add_rollups(batch, transaction):
+    rollups = collection(ROLLUP_COLLECTION)
+    for (document, data) in rollup_writes(transaction).items():
+        batch.set(rollups.document(document), data, merge=True)
+
+
+def write_transaction(reference, transaction):
+    # The finished transaction and its rollups are committed together, so the rollups never count a run twice.
+    batch = firestore_client().batch()
+    batch.set(reference, transaction)
+    add_rollups(batch, transaction)
+    with span("firestore.write transaction"):
+        batch.commit()
+
+
+def percentile(histogram, p):
+    total = sum(histogram.values())
+    if not total:
+        return None
+    seen = 0
+    for bucket in [str(bound) for bound in DURATION_BUCKETS] + ["inf"]:
+        seen += histogram.get(bucket, 0)
+        if seen >= total * p:
+            return f"> {DURATION_BUCKETS[-1]} s" if bucket == "inf" else f"≤ {bucket} s"
+
+
+def summarize_period(snapshot):
+    if not snapshot.exists:
+        return None
+    rollup = snapshot.to_dict()
+    return {
+        "key": rollup["key"],
+        "runs": rollup["runs"],
+        "cards": rollup["cards"],
+        "success_rate": rollup["successes"] / rollup["cards"] if rollup["cards"] else 0,
+        "mean_duration": rollup["duration_seconds"] / rollup["runs"],
+        "p50": percentile(rollup["durations"], 0.5),
+        "p90": percentile(rollup["durations"], 0.9),
+    }
+
+
+def card_rollups():
+    with span("firestore.read rollups"):
+        snapshot = collection(ROLLUP_COLLECTION).document(CARDS_DOCUMENT).get()
+    return snapshot.to_dict()["cards"] if snapshot.exists else {}
+
+
+def due_cards(card_names, max_idle_days, now=None):
+    # Cards whose last reload failed are retried first, followed by the longest idle ones. Cards that never succeeded
+    # count as idle forever.
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=max_idle_days)
+    rollups = card_rollups()
+
+    def failed(name):
+        return name in rollups and rollups[name]["last_result"] is False
+
+    def last_success(name):
+        return rollups.get(name, {}).get("last_success")
+
+    return sorted(
+        (
+            name
+            for name in card_names
+            if failed(name)
+            or last_success(name) is None
+            or last_success(name) <= cutoff
+        ),
+        key=lambda name: (
+            not failed(name),
+            last_success(name) is not None,
+            last_success(name) or cutoff,
+        ),
+    )
+
+
+def millis(timestamp):
+    return timestamp and timestamp.timestamp() * 1000
+
+
+def rollup_summary(now=None):
+    now = now or datetime.now(timezone.utc)
+    rollups = collection(ROLLUP_COLLECTION)
+    with span("firestore.read rollups"):
+        # get_all returns the documents in whatever order they arrive.
+        snapshots = {
+            snapshot.id: snapshot
+            for snapshot in firestore_client().get_all(
+                [
+                    rollups.document(CARDS_DOCUMENT),
+                    rollups.document(period_document("day", now)),
+                    rollups.document(period_document("month", now)),
+                ]
+            )
+        }
+    return {
+        "day": summarize_period(snapshots[period_document("day", now)]),
+        "month": summarize_period(snapshots[period_document("month", now)]),
+        "cards": sorted(
+            (
+                {
+                    "name": name,
+                    "runs": card["runs"],
+                    "success_rate": card["successes"] / card["runs"],
+                    "last_success": millis(card.get("last_success")),
+                    "last_failure": millis(card.get("last_failure")),
+                    "last_result": card["last_result"],
+                }
+                for (name, card) in (
+                    snapshots[CARDS_DOCUMENT].to_dict()["cards"]
+                    if snapshots[CARDS_DOCUMENT].exists
+                    else {}
+                ).items()
+            ),
+            key=lambda card: card["name"],
+        ),
+    }
+
+
+def backfill():
+    from google.cloud import firestore
+
+    for snapshot in collection(ROLLUP_COLLECTION).stream():
+        snapshot.reference.delete()
+    batch = firestore_client().batch()
+    count = 0
+    # Oldest first, so that the last success and failure of every card end up being the latest ones.
+    for snapshot in (
+        collection("transactions")
+        .order_by("timestamp_end", direction=firestore.Query.ASCENDING)
+        .stream()
+    ):
+        add_rollups(batch, snapshot.to_dict())
+        count += 1
+        if count % BACKFILL_BATCH_SIZE == 0:
+            batch.commit()
+            batch = firestore_client().batch()
+    batch.commit()
+    return count
+
+
+if __name__ == "__main__":
+    argparser = ArgumentParser(
+        description="A utility for maintaining the transaction rollups shown on the dashboard.",
+        allow_abbrev=False,
+    )
+    actions = argparser.add_mutually_exclusive_group(required=True)
+    actions.add_argument(
+        "--backfill",
+        action="store_true",
+        help="rebuild all rollups from the transaction history",
+    )
+    args = argparser.parse_args()
+    if args.backfill:
+        print(f"Rolled up {backfill()} transactions.")
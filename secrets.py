@@ -1,16 +1,36 @@
 from argparse import ArgumentParser
 from base64 import urlsafe_b64decode
 from base64 import urlsafe_b64encode
-from functools import lru_cache
 from functools import wraps
+from hashlib import sha256
 from json import dumps
+from json import loads
+from os import getenv
 from re import match
+from threading import Lock
+from time import monotonic
+from typing import Dict
+from typing import Tuple
 
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
-from google.cloud import firestore
 
-ENCRYPTED_COLLECTION = firestore.Client().collection("secrets")
+from clients import collection
+from clients import firestore_client
+from metrics import security_exceptions
+from tracing import span
+
+ENCRYPTED_COLLECTION = "secrets"
+# Decrypted secrets are kept in memory briefly so that a batch reads Firestore once. Writes from this process
+# invalidate the cache immediately, other processes (e.g. the CLI below) are picked up once the TTL expires.
+SECRETS_CACHE_TTL = int(getenv("SECRETS_CACHE_TTL", "60"))
+# Documents are written in this format. Readers understand every format, see migrate_documents.
+DOCUMENT_FORMAT_VERSION = 2
+
+# Key digests to (expiry, decrypted secrets).
+secrets_cache: Dict[str, Tuple[float, dict]] = {}
+card_names_cache = None
+secrets_cache_lock = Lock()
 
 
 class SecurityException(Exception):
@@ -29,6 +49,9 @@ def throwable(message):
             try:
                 return f(*args, **kwds)
             except Exception as inst:
+                # Only count the innermost failure of nested decryptions.
+                if not isinstance(inst, SecurityException):
+                    security_exceptions.inc()
                 raise SecurityException(message, inst)
 
         return wrapper
@@ -49,23 +72,43 @@ def is_encrypted_data(data):
     )
 
 
+def key_bytes(key):
+    return urlsafe_b64decode(key.encode("utf8"))
+
+
 def aes_encrypt(key, data):
-    cipher = AES.new(urlsafe_b64decode(key.encode("utf8")), AES.MODE_EAX)
+    cipher = AES.new(key_bytes(key), AES.MODE_EAX)
     ciphertext, tag = cipher.encrypt_and_digest(data.encode("utf8"))
     return {"nonce": cipher.nonce, "value": ciphertext, "tag": tag}
 
 
 @throwable("Incorrect key or invalid data!")
 def aes_decrypt(key, data):
-    cipher = AES.new(
-        urlsafe_b64decode(key.encode("utf8")), AES.MODE_EAX, nonce=data["nonce"]
-    )
+    cipher = AES.new(key_bytes(key), AES.MODE_EAX, nonce=data["nonce"])
     plaintext = cipher.decrypt(data["value"]).decode("utf8")
     cipher.verify(data["tag"])
     return plaintext
 
 
-def get_document(key, document_name):
+def encrypt_document(key, data, version=DOCUMENT_FORMAT_VERSION):
+    def encrypt_recursive(d):
+        return {
+            k: encrypt_recursive(v) if isinstance(v, dict) else aes_encrypt(key, v)
+            for (k, v) in d.items()
+        }
+
+    if version == 1:
+        return encrypt_recursive(data)
+    # v2 encrypts the whole document as a single blob. The top level field names stay readable, just like in v1,
+    # so that card names can still be listed without the key.
+    return {
+        "format": 2,
+        "fields": list(data.keys()),
+        **aes_encrypt(key, dumps(data)),
+    }
+
+
+def decrypt_document(key, document):
     def decrypt_recursive(d):
         return {
             k: aes_decrypt(key, v)
@@ -76,37 +119,116 @@ def get_document(key, document_name):
             for (k, v) in (d or {}).items()
         }
 
-    return decrypt_recursive(
-        ENCRYPTED_COLLECTION.document(document_name).get().to_dict()
-    )
+    if document_format(document) == 2:
+        return loads(aes_decrypt(key, document))
+    return decrypt_recursive(document)
+
+
+def document_format(document):
+    # v1 documents have no format marker, but may well contain a card named "format".
+    version = (document or {}).get("format")
+    return version if isinstance(version, int) else 1
+
+
+def document_fields(document):
+    if document_format(document) == 2:
+        return document["fields"]
+    return list((document or {}).keys())
+
+
+def get_document(key, document_name):
+    with span(f"firestore.read {document_name}"):
+        document = (
+            collection(ENCRYPTED_COLLECTION).document(document_name).get().to_dict()
+        )
+    return decrypt_document(key, document)
 
 
 def set_document(key, document_name, data):
-    def encrypt_recursive(d):
-        return {
-            k: encrypt_recursive(v) if isinstance(v, dict) else aes_encrypt(key, v)
-            for (k, v) in d.items()
+    with span(f"firestore.write {document_name}"):
+        collection(ENCRYPTED_COLLECTION).document(document_name).set(
+            encrypt_document(key, data)
+        )
+    invalidate_secrets()
+
+
+def migrate_documents(key):
+    migrated = []
+    for doc in collection(ENCRYPTED_COLLECTION).stream():
+        document = doc.to_dict()
+        if document_format(document) != DOCUMENT_FORMAT_VERSION:
+            set_document(key, doc.id, decrypt_document(key, document))
+            migrated.append(doc.id)
+    return migrated
+
+
+def invalidate_secrets():
+    global card_names_cache
+    with secrets_cache_lock:
+        secrets_cache.clear()
+        card_names_cache = None
+
+
+def cache_card_names(cards_document):
+    global card_names_cache
+    card_names = document_fields(cards_document)
+    with secrets_cache_lock:
+        card_names_cache = (monotonic() + SECRETS_CACHE_TTL, card_names)
+    return card_names
+
+
+def load_secrets(key):
+    # The cache is keyed by a digest so that the key itself is never held onto. Only keys that
+    # decrypted successfully ever make it into the cache.
+    digest = sha256(key.encode("utf8")).hexdigest()
+    with secrets_cache_lock:
+        cached = secrets_cache.get(digest)
+    if cached and cached[0] > monotonic():
+        return cached[1]
+    with span("firestore.read secrets"):
+        documents = {
+            snapshot.id: snapshot.to_dict()
+            for snapshot in firestore_client().get_all(
+                [
+                    collection(ENCRYPTED_COLLECTION).document("credentials"),
+                    collection(ENCRYPTED_COLLECTION).document("cards"),
+                ]
+            )
         }
-
-    ENCRYPTED_COLLECTION.document(document_name).set(encrypt_recursive(data))
+    secrets = {
+        "credentials": decrypt_document(key, documents.get("credentials")),
+        "cards": decrypt_document(key, documents.get("cards")),
+    }
+    cache_card_names(documents.get("cards"))
+    with secrets_cache_lock:
+        secrets_cache[digest] = (monotonic() + SECRETS_CACHE_TTL, secrets)
+    return secrets
 
 
 def get_credentials(key):
-    return get_document(key, "credentials")
+    return load_secrets(key)["credentials"]
 
 
-@lru_cache
 def get_card_names():
-    return ENCRYPTED_COLLECTION.document("cards").get().to_dict().keys()
+    with secrets_cache_lock:
+        cached = card_names_cache
+    if cached and cached[0] > monotonic():
+        return cached[1]
+    with span("firestore.read card names"):
+        cards_document = (
+            collection(ENCRYPTED_COLLECTION).document("cards").get().to_dict()
+        )
+    return cache_card_names(cards_document)
 
 
 def get_cards(key):
-    return get_document(key, "cards")
+    return load_secrets(key)["cards"]
 
 
 def reset_secrets(new_username, new_password):
-    for doc in ENCRYPTED_COLLECTION.stream():
+    for doc in collection(ENCRYPTED_COLLECTION).stream():
         doc.reference.delete()
+    invalidate_secrets()
     new_key = gen_new_key()
     set_document(
         new_key, "credentials", {"username": new_username, "password": new_password}
@@ -143,6 +265,11 @@ if __name__ == "__main__":
     actions.add_argument(
         "--add-cards", action="store_true", help="add cards to db secrets"
     )
+    actions.add_argument(
+        "--migrate",
+        action="store_true",
+        help=f"rewrite saved secrets in the v{DOCUMENT_FORMAT_VERSION} storage format",
+    )
     args = argparser.parse_args()
     if args.read:
         secret_key = input("Enter key to retrieve secrets: ")
@@ -150,7 +277,7 @@ if __name__ == "__main__":
             dumps(
                 {
                     doc.id: get_document(secret_key, doc.id)
-                    for doc in ENCRYPTED_COLLECTION.stream()
+                    for doc in collection(ENCRYPTED_COLLECTION).stream()
                 }
             )
         )
@@ -174,3 +301,10 @@ if __name__ == "__main__":
                 )
             except EOFError:
                 break
+    if args.migrate:
+        secret_key = input("Enter your encryption key: ")
+        get_credentials(secret_key)
+        migrated = migrate_documents(secret_key)
+        print(
+            f'Migrated {len(migrated)} documents to v{DOCUMENT_FORMAT_VERSION}: {", ".join(migrated) or "none"}.'
+        )
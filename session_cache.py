@@ -0,0 +1,63 @@
+from datetime import datetime
+from datetime import timezone
+from functools import wraps
+from json import dumps
+from json import loads
+from os import getenv
+from secrets import aes_decrypt
+from secrets import aes_encrypt
+from secrets import SecurityException
+
+from clients import collection
+from tracing import traced
+
+SESSION_CACHE_ENABLED = getenv("SESSION_CACHE", "").lower() in ("1", "true", "yes")
+SESSION_COLLECTION = "sessions"
+SESSION_DOCUMENT = "amazon"
+
+
+class SessionCacheException(Exception):
+    def __init__(self, message, exception):
+        self.message = message
+        self.exception = exception
+
+    def __str__(self):
+        return f"SessionCacheException: {self.message}\n{self.exception}"
+
+
+def throwable(message):
+    def throwable(f):
+        @wraps(f)
+        def wrapper(*args, **kwds):
+            try:
+                return f(*args, **kwds)
+            except Exception as inst:
+                raise SessionCacheException(message, inst)
+
+        return wrapper
+
+    return throwable
+
+
+@throwable("Unable to load cached session cookies!")
+@traced("firestore.read session")
+def load_cookies(key):
+    data = collection(SESSION_COLLECTION).document(SESSION_DOCUMENT).get().to_dict()
+    if not data:
+        return None
+    try:
+        return loads(aes_decrypt(key, data["cookies"]))
+    except SecurityException:
+        # Cookies saved under a previous secret key are treated as a cache miss.
+        return None
+
+
+@throwable("Unable to save session cookies!")
+@traced("firestore.write session")
+def save_cookies(key, cookies):
+    collection(SESSION_COLLECTION).document(SESSION_DOCUMENT).set(
+        {
+            "cookies": aes_encrypt(key, dumps(cookies)),
+            "timestamp": datetime.now(timezone.utc),
+        }
+    )
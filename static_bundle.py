@@ -0,0 +1,147 @@
+from argparse import ArgumentParser
+from base64 import b64encode
+from functools import lru_cache
+from hashlib import sha256
+from hashlib import sha384
+from json import dumps
+from json import loads
+from os import makedirs
+from os import path
+from re import sub
+from shutil import rmtree
+from urllib.parse import urljoin
+from urllib.parse import urlsplit
+from urllib.request import urlopen
+
+STATIC_DIR = path.join(path.dirname(path.abspath(__file__)), "static")
+# Served with immutable cache headers, see app.yaml, so every file name carries a digest of its contents.
+BUNDLE_DIR = path.join(STATIC_DIR, "dist")
+MANIFEST = path.join(BUNDLE_DIR, "manifest.json")
+# Third party assets in the order they are bundled, pinned by their subresource integrity hashes.
+VENDOR_CSS = [
+    (
+        "https://stackpath.bootstrapcdn.com/bootstrap/4.5.0/css/bootstrap.min.css",
+        "sha384-9aIt2nRpC12Uk9gS9baDl411NQApFmC26EwAOH8WgZl5MYYxFfc+NcPb1dKGj7Sk",
+    ),
+    (
+        "https://stackpath.bootstrapcdn.com/font-awesome/4.7.0/css/font-awesome.min.css",
+        "sha384-wvfXpqpZZVQGK6TAh5PVlGOfQNHSoD2xbE+QkPxCAFlNEevoEH3Sl0sibVcOQVnN",
+    ),
+]
+VENDOR_JS = [
+    (
+        "https://code.jquery.com/jquery-3.5.1.slim.min.js",
+        "sha384-DfXdz2htPH0lsSSs5nCTpuj/zy4C+OGpamoFVy38MVBnE+IbbVYUew+OrCXaRkfj",
+    ),
+    (
+        "https://cdn.jsdelivr.net/npm/popper.js@1.16.0/dist/umd/popper.min.js",
+        "sha384-Q6E9RHvbIyZFJoft+2mJbHaEWldlvI9IOYy5n3zV9zzTtmI3UksdQRVvoxMfooAo",
+    ),
+    (
+        "https://stackpath.bootstrapcdn.com/bootstrap/4.5.0/js/bootstrap.min.js",
+        "sha384-OgVRvuATP1z7JjHLkuOU7Xw704+h835Lr+6QL9UvYjZE3Ipu6Tp75j7Bh/kR0JKI",
+    ),
+    (
+        "https://cdn.jsdelivr.net/npm/moment@2.27.0/moment.min.js",
+        "sha384-CJyhAlbbRZX14Q8KxKBt0na1ad4KBs9PklAiNk2Efxs9sgimbIZm9kYLJQeNMUfM",
+    ),
+]
+LOCAL_CSS = ["status.css"]
+LOCAL_FILES = [
+    "app-engine.svg",
+    "compute-engine.svg",
+    "logging.svg",
+    "favicon.svg",
+    "favicon.ico",
+]
+
+
+class StaticBundleException(Exception):
+    def __init__(self, message, exception):
+        self.message = message
+        self.exception = exception
+
+    def __str__(self):
+        return f"StaticBundleException: {self.message}\n{self.exception}"
+
+
+def download(url, integrity=None):
+    with urlopen(url) as response:
+        data = response.read()
+    if integrity and integrity != f"sha384-{b64encode(sha384(data).digest()).decode()}":
+        raise StaticBundleException(f"{url} does not match its integrity hash!", None)
+    return data
+
+
+def write_fingerprinted(name, data):
+    (stem, extension) = path.splitext(name)
+    fingerprinted = f"{stem}.{sha256(data).hexdigest()[:12]}{extension}"
+    with open(path.join(BUNDLE_DIR, fingerprinted), "wb") as file:
+        file.write(data)
+    return fingerprinted
+
+
+def inline_urls(css, base_url):
+    # Fonts and images referenced by third party stylesheets are fingerprinted next to the bundle, keeping any query
+    # or fragment since some of them (e.g. ?#iefix) are load-bearing.
+    def replace(match):
+        url = match.group(2)
+        if url.startswith("data:"):
+            return match.group(0)
+        parts = urlsplit(urljoin(base_url, url))
+        fingerprinted = write_fingerprinted(
+            path.basename(parts.path),
+            download(f"{parts.scheme}://{parts.netloc}{parts.path}"),
+        )
+        suffix = url[len(url.split("?")[0].split("#")[0]) :]
+        return f"url({match.group(1)}{fingerprinted}{suffix}{match.group(1)})"
+
+    return sub(r"""url\((['"]?)([^'")]+)\1\)""", replace, css)
+
+
+def build():
+    if path.isdir(BUNDLE_DIR):
+        rmtree(BUNDLE_DIR)
+    makedirs(BUNDLE_DIR)
+    manifest = {}
+    css = [inline_urls(download(*asset).decode(), asset[0]) for asset in VENDOR_CSS]
+    for name in LOCAL_CSS:
+        with open(path.join(STATIC_DIR, name), encoding="utf8") as file:
+            css.append(file.read())
+    manifest["bundle.css"] = write_fingerprinted("bundle.css", "\n".join(css).encode())
+    # Minified scripts may end without a semicolon or newline.
+    manifest["bundle.js"] = write_fingerprinted(
+        "bundle.js", b";\n".join(download(*asset) for asset in VENDOR_JS)
+    )
+    for name in LOCAL_FILES:
+        with open(path.join(STATIC_DIR, name), "rb") as file:
+            manifest[name] = write_fingerprinted(name, file.read())
+    with open(MANIFEST, "w", encoding="utf8") as file:
+        file.write(dumps(manifest, indent=2))
+    return manifest
+
+
+@lru_cache(maxsize=None)
+def load_manifest():
+    # Without a build the dashboard falls back to the CDNs and the unbundled files.
+    try:
+        with open(MANIFEST, encoding="utf8") as file:
+            return loads(file.read())
+    except FileNotFoundError:
+        return {}
+
+
+if __name__ == "__main__":
+    argparser = ArgumentParser(
+        description="A utility for bundling and fingerprinting the dashboard's static assets.",
+        allow_abbrev=False,
+    )
+    actions = argparser.add_mutually_exclusive_group(required=True)
+    actions.add_argument(
+        "--build",
+        action="store_true",
+        help=f"download, bundle and fingerprint every asset into {BUNDLE_DIR}",
+    )
+    args = argparser.parse_args()
+    if args.build:
+        print(f"Bundled {len(build())} assets.")
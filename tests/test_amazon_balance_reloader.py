@@ -0,0 +1,63 @@
+import pytest
+from selenium.common.exceptions import WebDriverException
+
+from amazon_balance_reloader import AmazonBalanceReloader
+from amazon_balance_reloader import AmazonBalanceReloaderException
+
+
+class StubElement:
+    def is_displayed(self):
+        return True
+
+
+class StubDriver:
+    def __init__(self, fail_sign_out=False):
+        self.fail_sign_out = fail_sign_out
+        self.quits = 0
+
+    def implicitly_wait(self, seconds):
+        pass
+
+    def set_page_load_timeout(self, seconds):
+        pass
+
+    def execute(self, command, params=None):
+        return {"value": None}
+
+    def get_log(self, log_type):
+        return []
+
+    def execute_script(self, script):
+        return None
+
+    def get(self, url):
+        if self.fail_sign_out:
+            raise WebDriverException("sign-out failed")
+
+    def find_element(self, by, value):
+        return StubElement()
+
+    def quit(self):
+        self.quits += 1
+
+
+def test_exit_quits_driver_after_sign_out():
+    driver = StubDriver()
+    with AmazonBalanceReloader(driver):
+        pass
+    assert driver.quits == 1
+
+
+def test_exit_quits_driver_when_keeping_session():
+    driver = StubDriver()
+    with AmazonBalanceReloader(driver) as reloader:
+        reloader.keep_session = True
+    assert driver.quits == 1
+
+
+def test_exit_quits_driver_when_sign_out_fails():
+    driver = StubDriver(fail_sign_out=True)
+    with pytest.raises(AmazonBalanceReloaderException):
+        with AmazonBalanceReloader(driver):
+            pass
+    assert driver.quits == 1
@@ -0,0 +1,37 @@
+from threading import Thread
+
+from coalescing import BatchCoalescer
+
+
+def reload_batch(cards, sessions):
+    names = list(cards.keys())
+    return {
+        "cards": names,
+        "success": [name != "b" for name in names],
+        "checkpoints": [{"attempts": 1, "error": name} for name in names],
+    }
+
+
+def test_coalesced_requests_only_get_their_cards():
+    coalescer = BatchCoalescer(0.2)
+    results = {}
+
+    def run(request, cards):
+        results[request] = coalescer.run("group", cards, 1, reload_batch)
+
+    leader = Thread(target=run, args=("leader", {"a": "1", "c": "3"}))
+    leader.start()
+    follower = Thread(target=run, args=("follower", {"b": "2"}))
+    follower.start()
+    leader.join()
+    follower.join()
+    assert results["leader"]["cards"] == ["a", "c"]
+    assert results["leader"]["success"] == [True, True]
+    assert results["leader"]["checkpoints"] == [
+        {"attempts": 1, "error": "a"},
+        {"attempts": 1, "error": "c"},
+    ]
+    assert results["follower"]["cards"] == ["b"]
+    assert results["follower"]["success"] == [False]
+    assert results["follower"]["checkpoints"] == [{"attempts": 1, "error": "b"}]
+    assert results["follower"]["coalesced_requests"] == 2
@@ -0,0 +1,73 @@
+from contextlib import contextmanager
+from functools import wraps
+from threading import local
+from threading import Lock
+from time import perf_counter
+
+from metrics import span_seconds
+
+active = local()
+
+
+class Trace:
+    def __init__(self):
+        self.origin = perf_counter()
+        self.spans = []
+        self.lock = Lock()
+
+    def record(self, name, start, end):
+        with self.lock:
+            self.spans.append(
+                {
+                    "name": name,
+                    "start": round((start - self.origin) * 1000, 1),
+                    "duration": round((end - start) * 1000, 1),
+                }
+            )
+
+    @contextmanager
+    def activate(self):
+        previous = getattr(active, "trace", None)
+        active.trace = self
+        try:
+            yield self
+        finally:
+            active.trace = previous
+
+    def bind(self, f):
+        # Carries the trace over to functions that run on other threads.
+        @wraps(f)
+        def wrapper(*args, **kwds):
+            with self.activate():
+                return f(*args, **kwds)
+
+        return wrapper
+
+
+@contextmanager
+def span(name, metric=None):
+    # Every span is also observed in the span_seconds histogram, under metric if the name holds a card name or the
+    # like, so that the number of series stays bounded.
+    trace = getattr(active, "trace", None)
+    outcome = "error"
+    start = perf_counter()
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        end = perf_counter()
+        span_seconds.observe(end - start, span=metric or name, outcome=outcome)
+        if trace is not None:
+            trace.record(name, start, end)
+
+
+def traced(name):
+    def traced(f):
+        @wraps(f)
+        def wrapper(*args, **kwds):
+            with span(name):
+                return f(*args, **kwds)
+
+        return wrapper
+
+    return traced